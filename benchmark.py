@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+# MP3 Cleaner benchmark - generates a synthetic music library and times
+# every stage of MP3 Cleaner working on it.
+# Copyright (C) 2020 Christopher Blachewicz (call911@pm.me)
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import json
+import random
+import resource
+import struct
+import sys
+import zlib
+from argparse   import ArgumentParser
+from contextlib import redirect_stdout
+from io         import StringIO
+from os         import makedirs, path, remove
+from shutil     import rmtree
+from subprocess import run
+from tempfile   import mkdtemp
+from time       import perf_counter
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# MPEG-1 layer III frame header (128 kbps, 44.1 kHz, no padding), with
+# silent payload: 417 bytes, 1152 samples
+MP3_FRAME      = b'\xff\xfb\x90\x64' + bytes(413)
+
+# 8x8 baseline jpg saved at quality 100, used when Pillow is missing;
+# comment segments inflate it to any size
+JPG_8X8        = base64.b64decode(
+  '/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEB'
+  'AQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/2wBDAQEBAQEBAQEBAQEBAQEB'
+  'AQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/wAAR'
+  'CAAIAAgDASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAA'
+  'AgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkK'
+  'FhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWG'
+  'h4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl'
+  '5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREA'
+  'AgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYk'
+  'NOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOE'
+  'hYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk'
+  '5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwDuKKKK/wAVz/Xg/9k=')
+
+ARTISTS        = ('the beatles', 'dj shadow', 'band, the', 'massive attack',
+                  'BOARDS OF CANADA', 'Aphex Twin', 'mc solaar',
+                  'crosby, stills & nash', 'the prodigy', 'Björk')
+WORDS          = ('love', 'night', 'song', 'heart', 'fire', 'moon', 'rain',
+                  'dancing', 'in', 'of', 'the', 'a', 'with', 'don\'t',
+                  'stop', 'ain\'t', 'nothing', 'like', 'city', 'lights')
+TITLE_ENDINGS  = ('', '', '', '', ' (original mix)', ' [bonus track]',
+                  ' (prod. by someone)', ' (radio edit)', ' (live)',
+                  ' (explicit)', ' (instrumental)', ' (extended mix)',
+                  ' part II', ' part IV', ' vol. XIX', ' (x remix)')
+ALBUM_ENDINGS  = ('', '', '', ' lp', ' ep', ' (original soundtrack)')
+
+STAGES         = ('scan', 'dedupe', 'validate', 'images', 'extract',
+                  'capitalize', 'regex', 'save')
+
+
+def id3_tag(fields):
+    '''Renders ID3v2.3 tag with latin-1 text frames and some padding.'''
+    frames = b''
+    for frame_id, text in fields.items():
+        if text:
+            data    = b'\x00' + text.encode('latin-1', 'replace')
+            frames += (frame_id.encode() + struct.pack('>I', len(data)) +
+                       b'\x00\x00' + data)
+
+    size = len(frames) + 256
+    return (b'ID3\x03\x00\x00' +
+            bytes([size >> 21 & 0x7f, size >> 14 & 0x7f, size >> 7 & 0x7f,
+                   size & 0x7f]) +
+            frames + bytes(256))
+
+
+def write_mp3(filepath, fields, n_frames):
+    '''
+    Writes a track of silent frames, but for its path in the payload of
+    the first one, so no two tracks have the same audio.
+    '''
+    with open(filepath, 'wb') as f:
+        f.write(id3_tag(fields))
+        f.write(MP3_FRAME[:4] + filepath.encode()[-413:].ljust(413, b'\0'))
+        f.write(MP3_FRAME * (n_frames - 1))
+
+
+def write_png(filepath, side, rng):
+    '''Writes a side x side png of RGB noise, with zlib only.'''
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data)))
+
+    rows = b''.join(b'\x00' + bytes(rng.getrandbits(8)
+                                    for _ in range(side * 3))
+                    for _ in range(side))
+    with open(filepath, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' +
+                chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, 2,
+                                           0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(rows, 1)) +
+                chunk(b'IEND', b''))
+
+
+def write_jpg(filepath, side, rng):
+    '''Writes a quality 100 jpg of about side x side pixels of noise.'''
+    if Image:
+        noise = Image.effect_noise((side, side), 64).convert('RGB')
+        noise.save(filepath, quality=100)
+        return
+
+    target   = side * side
+    comments = b''
+    while len(JPG_8X8) + len(comments) < target:
+        filler    = bytes(min(65533, target - len(comments)))
+        comments += b'\xff\xfe' + struct.pack('>H', len(filler) + 2) + filler
+    with open(filepath, 'wb') as f:
+        f.write(JPG_8X8[:2] + comments + JPG_8X8[2:])
+
+
+def random_text(rng, n_words, endings=('',)):
+    words = ' '.join(rng.choice(WORDS) for _ in range(n_words))
+    return words + rng.choice(endings)
+
+
+def track_fields(rng, artist, album, track_num, album_track=False,
+                 year=None):
+    '''
+    Tag fields of a track, in varying shape. Some album tracks have no
+    track number, it has to be read from file name then. Album tracks
+    share the year of their album, singles get a random one.
+    '''
+    title = random_text(rng, rng.randint(1, 5), TITLE_ENDINGS)
+    if rng.random() < 0.1:
+        title += f' (feat. {rng.choice(ARTISTS)})'
+    if rng.random() < 0.1:
+        artist += f' feat. {rng.choice(ARTISTS)}'
+
+    return {'TPE1': artist,
+            'TALB': album,
+            'TIT2': title,
+            'TYER': str(year or rng.randint(1960, 2020)),
+            'TRCK': '' if album_track and rng.random() < 0.1
+                    else str(track_num)}
+
+
+def generate_library(root, opts, rng):
+    '''
+    Fills root with singles, albums, multi-CD albums, album art, junk,
+    broken mp3s and non-mp3 albums. Returns counts of generated files.
+    '''
+    counts = dict.fromkeys(('mp3', 'broken', 'images', 'junk', 'other'), 0)
+    makedirs(root)
+
+    for n in range(opts.singles):
+        artist = rng.choice(ARTISTS)
+        fields = track_fields(rng, artist, random_text(rng, 2), n % 20 + 1)
+        write_mp3(f'{root}/{artist} - single {n}.mp3', fields, opts.frames)
+        counts['mp3'] += 1
+
+    for n in range(opts.albums + opts.multi_cd):
+        artist    = rng.choice(ARTISTS)
+        album     = random_text(rng, rng.randint(1, 4), ALBUM_ENDINGS)
+        year      = rng.randint(1960, 2020)
+        album_dir = f'{root}/{artist} - album {n}'
+        cd_dirs   = [album_dir]
+        if n >= opts.albums:
+            cd_dirs = [f'{album_dir}/CD{cd}' for cd in (1, 2)]
+
+        for cd_dir in cd_dirs:
+            makedirs(cd_dir, exist_ok=True)
+            for track_num in range(1, opts.tracks + 1):
+                fields = track_fields(rng, artist, album, track_num, True,
+                                      year)
+                write_mp3(f'{cd_dir}/{track_num:02} track.mp3', fields,
+                          opts.frames)
+                counts['mp3'] += 1
+
+        write_png(f'{album_dir}/Folder.png', 160, rng)
+        write_jpg(f'{album_dir}/back.jpg', 160, rng)
+        write_jpg(f'{album_dir}/small.jpeg', 16, rng)
+        counts['images'] += 3
+
+        for junk in ('info.nfo', 'playlist.m3u', 'website.url'):
+            with open(f'{album_dir}/{junk}', 'w') as f:
+                f.write(random_text(rng, 20))
+            counts['junk'] += 1
+
+        if n < opts.broken:
+            with open(f'{album_dir}/99 broken.mp3', 'w') as f:
+                f.write(random_text(rng, 100))
+            counts['broken'] += 1
+
+    for n in range(opts.notmp3):
+        makedirs(f'{root}/flac album {n}')
+        with open(f'{root}/flac album {n}/01 track.flac', 'wb') as f:
+            f.write(b'fLaC' + bytes(1024))
+        counts['other'] += 1
+
+    return counts
+
+
+def write_settings(work_dir, opts):
+    '''Writes settings.py copy pointing the program at work_dir.'''
+    settings_path = path.join(path.dirname(path.abspath(__file__)),
+                              'settings.py')
+    with open(settings_path) as f:
+        settings = f.read()
+
+    overrides = {'base_dir':         f'{work_dir}/library',
+                 'dest_dir':         f'{work_dir}/music',
+                 'tag_changes_file': f'{work_dir}/tag_changes.yaml',
+                 'title_cache_file': f'{work_dir}/titles.db',
+                 'img_cache_dir':    f'{work_dir}/images',
+                 'manifest_file':    f'{work_dir}/manifest.db',
+                 'journal_file':     f'{work_dir}/journal.jsonl',
+                 'text_editor':      '',
+                 'app_blacklist':    []}
+    if opts.no_mp3val:
+        overrides['enable_mp3val'] = False
+    if opts.no_nlp:
+        overrides['enable_nlp'] = False
+    if opts.no_images:
+        overrides['img_conv_compr'] = False
+    if opts.img_backend:
+        overrides['img_backend'] = opts.img_backend
+
+    settings += '\n\n# Benchmark overrides\n'
+    settings += ''.join(f'{key} = {val!r}\n' for key, val in overrides.items())
+    with open(f'{work_dir}/settings.py', 'w') as f:
+        f.write(settings)
+    return f'{work_dir}/settings.py'
+
+
+def stage_files(stage, counts):
+    '''Number of files a stage works through, for throughput.'''
+    if stage == 'scan':
+        return sum(counts.values())
+    if stage == 'validate':
+        return counts['mp3'] + counts['broken']
+    if stage == 'images':
+        return counts['images']
+    return counts['mp3']
+
+
+def main():
+    parser = ArgumentParser(description='Generates a synthetic music '
+                                        'library and times each stage of '
+                                        'MP3 Cleaner working on it.')
+    parser.add_argument('--singles', type=int, default=200)
+    parser.add_argument('--albums', type=int, default=40)
+    parser.add_argument('--multi-cd', type=int, default=10,
+                        help='number of albums split into two CD subdirs')
+    parser.add_argument('--tracks', type=int, default=10,
+                        help='tracks per album (per CD)')
+    parser.add_argument('--broken', type=int, default=5,
+                        help='number of albums with a broken mp3')
+    parser.add_argument('--notmp3', type=int, default=2,
+                        help='number of flac albums')
+    parser.add_argument('--frames', type=int, default=200,
+                        help='mp3 frames per track (38 per second)')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='runs on freshly generated library, caches '
+                             'are kept between them')
+    parser.add_argument('--subprocess', action='store_true',
+                        help='start the program anew for each run, as from '
+                             'command line, instead of running all of them '
+                             'in this process')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--no-mp3val', action='store_true')
+    parser.add_argument('--no-nlp', action='store_true')
+    parser.add_argument('--no-images', action='store_true',
+                        help='skip image conversion and compression')
+    parser.add_argument('--img-backend', choices=('magick', 'pillow'),
+                        help='override img_backend setting')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep generated files')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write results to given file, as JSON')
+    opts = parser.parse_args()
+
+    work_dir      = mkdtemp(prefix='mp3cleaner-bench-')
+    settings_path = write_settings(work_dir, opts)
+    program       = path.join(path.dirname(path.abspath(__file__)),
+                              'mp3cleaner.py')
+    results       = []
+    cleaner       = None
+
+    # One cleaner does all runs, keeping parsed files, caches and models
+    # loaded between them, like a long-running process would
+    if not opts.subprocess:
+        import mp3cleaner
+
+        cleaner = mp3cleaner.Cleaner(mp3cleaner.load_settings(settings_path),
+                                     jobs=opts.jobs)
+        rusage  = resource.RUSAGE_SELF
+    else:
+        rusage  = resource.RUSAGE_CHILDREN
+
+    for run_num in range(1, opts.runs + 1):
+        for generated in ('library', 'music'):
+            rmtree(f'{work_dir}/{generated}', ignore_errors=True)
+
+        start  = perf_counter()
+        counts = generate_library(f'{work_dir}/library', opts,
+                                  random.Random(opts.seed))
+        gen_time = perf_counter() - start
+
+        if cleaner:
+            output = StringIO()
+            start  = perf_counter()
+            try:
+                with redirect_stdout(output):
+                    cleaner.clean()
+            except (SystemExit, Exception) as err:
+                sys.exit(f'MP3 Cleaner failed:\n{output.getvalue()}{err!r}')
+            wall_time = perf_counter() - start
+            stages    = cleaner.metrics.report()['stages']
+
+        else:
+            start = perf_counter()
+            proc  = run([sys.executable, program, '--settings', settings_path,
+                         '--metrics', f'{work_dir}/metrics.json',
+                         '--jobs', str(opts.jobs)],
+                        capture_output=True, text=True)
+            wall_time = perf_counter() - start
+            if proc.returncode or \
+               not path.isfile(f'{work_dir}/metrics.json'):
+                sys.exit(f'MP3 Cleaner failed:\n{proc.stdout}{proc.stderr}')
+
+            with open(f'{work_dir}/metrics.json') as f:
+                stages = json.load(f)['stages']
+            remove(f'{work_dir}/metrics.json')
+
+        # Peak over all runs so far: the kernel only keeps maximum RSS
+        # of the process, or of all its finished children
+        peak_rss = resource.getrusage(rusage).ru_maxrss
+
+        print(f'\nRun {run_num}: {counts["mp3"]} mp3s, {counts["images"]} '
+              f'images, {counts["junk"]} junk files, {counts["broken"]} '
+              f'broken, generated in {gen_time:.2f}s')
+        print(f' {"stage":<12}{"seconds":>10}{"files/s":>12}')
+        for stage in STAGES:
+            secs    = stages.get(stage, {}).get('wall_seconds', 0)
+            n_files = stage_files(stage, counts)
+            rate    = f'{n_files / secs:.0f}' if secs else '-'
+            print(f' {stage:<12}{secs:>10.3f}{rate:>12}')
+        print(f' {"total":<12}{wall_time:>10.3f}'
+              f'{sum(counts.values()) / wall_time:>12.0f}')
+        print(f' peak RSS: {peak_rss / 1024:.1f} MiB')
+
+        results.append({'counts': counts, 'stages': stages,
+                        'wall_time': wall_time, 'peak_rss_kib': peak_rss})
+
+    if cleaner:
+        cleaner.close()
+
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if opts.keep:
+        print(f'\nGenerated files kept in {work_dir}')
+    else:
+        rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,675 +17,4002 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
+import base64
+import hashlib
+import json
+import mmap
 import re
+import resource
+import sqlite3
+import struct
 import sys
-from glob       import glob
-from os         import (devnull, listdir, makedirs, path, popen, remove,
-                        renames, rmdir, walk)
+from argparse   import ArgumentParser
+from errno      import (EINVAL, EMLINK, ENOENT, ENOSYS, ENOTDIR, ENOTTY,
+                        EOPNOTSUPP, EPERM, EXDEV)
+from importlib.util import module_from_spec, spec_from_file_location
+from itertools  import islice
+from os         import (devnull, fsdecode, fsencode, fsync, getpid, link,
+                        makedirs, path, remove, renames, replace, rmdir,
+                        scandir, sendfile, stat, strerror, times, wait4,
+                        walk)
+from select     import select
+from shutil     import copyfileobj, copymode
 from subprocess import DEVNULL, PIPE, run
+from tempfile   import NamedTemporaryFile
+from threading  import Lock, local
+from time       import monotonic, perf_counter, time
+try:
+    from time   import thread_time
+except ImportError:  # Python 3.6
+    from time   import process_time as thread_time
+
+
+# Standard libjpeg luminance quantization table, quality 50
+JPG_LUMA_TABLE = (16,  11,  10,  16,  24,  40,  51,  61,
+                  12,  12,  14,  19,  26,  58,  60,  55,
+                  14,  13,  16,  24,  40,  57,  69,  56,
+                  14,  17,  22,  29,  51,  87,  80,  62,
+                  18,  22,  37,  56,  68, 109, 103,  77,
+                  24,  35,  55,  64,  81, 104, 113,  92,
+                  49,  64,  78,  87, 103, 121, 120, 101,
+                  72,  92,  95,  98, 112, 100, 103,  99)
+
+
+# MPEG audio frame header values: bitrates in kbps by (MPEG-1, layer
+# bits), sample rates by version bits, samples per frame by (MPEG-1,
+# layer bits). Layer bits 3, 2, 1 stand for layers I, II, III, version
+# bits 3, 2, 0 for MPEG-1, MPEG-2 and MPEG-2.5
+MPEG_BITRATES = {
+  (True,  3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+               416, 448),
+  (True,  2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+               384),
+  (True,  1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+               320),
+  (False, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+               256),
+  (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+  (False, 1): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}
+MPEG_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000),
+                     0: (11025, 12000, 8000)}
+MPEG_SAMPLES      = {(True, 3): 384, (True, 2): 1152, (True, 1): 1152,
+                     (False, 3): 384, (False, 2): 1152, (False, 1): 576}
+
+# Header bits every frame of a stream shares: sync, version, layer and
+# sample rate
+MPEG_STREAM_MASK = 0xfffe0c00
+
+
+# Linux ioctl request which makes a file share all data blocks of another
+FICLONE = 0x40049409
+
+
+# Patterns used on every extracted tag, compiled once
+EP_SUFFIX_RGX    = re.compile(' [\(\[]?[Ee][Pp][\\)\]]?$')
+EP_WORD_RGX      = re.compile(r'\b[Ee][Pp]\b(?!\.)')
+TRACK_NUM_RGX    = re.compile('\d\d?')
+CD_DIR_RGX       = re.compile(r'\.CD(\d+)$')
+FIRST_LETTER_RGX = re.compile(r'(?:^|(?<="))\w', re.M)
+
+# Low Roman numerals and their replacements, tried in this order
+ROMANS = {'XX':'20', 'XIX':'19', '18':'XVIII', 'XVII':'17', 'XVI':'16',
+          'XV:':'15:', 'XV':'15', 'XIV:':'14:', 'XIV':'14', 'XIII:':'13:',
+          'XIII':'13', 'XII:':'12:', 'XII':'12', 'XI:':'9:', 'XI':'9',
+          ' X ': ' 10 ', 'IX:':'9:', 'IX':'9', 'VIII:':'8:', 'VIII':'8',
+          'VII:':'7:', 'VII':'7', 'VI:':'6:', 'VI':'6', ' V ':' 5 ',
+          'IV:':'4:', 'IV':'4', 'V:':'5:', 'III:':'3:', 'III':'3',
+          'II:':'2:', 'II':'2'}
+ROMAN_RULES = [(roman, re.compile(roman), arabic)
+               for roman, arabic in ROMANS.items()]
+ROMAN_V_RGX = re.compile(' V$')
 
-import eyed3
-
-import settings as s
-if s.enable_nlp:
-    import spacy
 
+class NoStdErr:
+    '''
+    Dumps all errors during code execution to /dev/null.
 
+    Can be nested and used from several threads at once: stderr is
+    swapped by the outermost block only.
+    '''
+    _lock  = Lock()
+    _depth = 0
 
-class NoStdErr:
-    '''Dumps all errors during code execution to /dev/null.'''
     def __enter__(self):
-        self._original_stderr = sys.stderr
-        sys.stderr            = open(devnull, 'w')
+        with NoStdErr._lock:
+            if not NoStdErr._depth:
+                NoStdErr._original_stderr = sys.stderr
+                sys.stderr                = open(devnull, 'w')
+            NoStdErr._depth += 1
     def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stderr.close()
-        sys.stderr = self._original_stderr
+        with NoStdErr._lock:
+            NoStdErr._depth -= 1
+            if not NoStdErr._depth:
+                sys.stderr.close()
+                sys.stderr = NoStdErr._original_stderr
 
 
-def report_current(filename):
-    '''Prints which file is being worked and total queue size.'''
-    global curr_file
+class Metrics:
+    '''
+    Measures where a run spends its time and what it does there.
+
+    The run is a sequence of stages; switching to a stage charges
+    everything since the previous switch to the previous stage: wall
+    time, CPU time (of this process and of finished child processes),
+    bytes read and written by this process (from /proc/self/io, zeros
+    where it's missing). Counters of files, eyed3 loads, saves, moves,
+    spawned programs and such go to the current stage too, from any
+    thread.
+    '''
+    COLUMNS = ('files', 'loads', 'saves', 'moves', 'spawns')
+
+    def __init__(self):
+        self.stages  = {}
+        self.current = None
+        self.last    = self.snapshot()
+        self.lock    = Lock()
+
+    @staticmethod
+    def snapshot():
+        cpu_times = times()
+        io        = {}
+        try:
+            with open('/proc/self/io') as f:
+                for line in f:
+                    key, _, val = line.partition(':')
+                    io[key] = int(val)
+        except OSError:
+            pass
+        return (perf_counter(), sum(cpu_times[:4]), io.get('rchar', 0),
+                io.get('wchar', 0))
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                 'read_bytes': 0, 'written_bytes': 0}
+        return self.stages[name]
+
+    def switch(self, name):
+        '''Starts a new stage (None for none), returns the previous one.'''
+        now = self.snapshot()
+        with self.lock:
+            if self.current:
+                stage = self.stage(self.current)
+                for key, start, end in zip(('wall_seconds', 'cpu_seconds',
+                                            'read_bytes', 'written_bytes'),
+                                           self.last, now):
+                    stage[key] += end - start
+            previous, self.current, self.last = self.current, name, now
+        return previous
+
+    def count(self, counter, n=1):
+        with self.lock:
+            stage          = self.stage(self.current or 'other')
+            stage[counter] = stage.get(counter, 0) + n
+
+    def report(self):
+        return {'stages':       self.stages,
+                'peak_rss_kib': resource.getrusage(
+                                  resource.RUSAGE_SELF).ru_maxrss,
+                'finished':     time()}
+
+    def summary(self):
+        '''Returns a table of all stages, as text.'''
+        lines = [f'{"stage":<10}{"wall s":>8}{"cpu s":>8}{"read MB":>9}'
+                 f'{"write MB":>9}' +
+                 ''.join(f'{col:>7}' for col in self.COLUMNS)]
+        for name, stage in self.stages.items():
+            lines.append(f'{name:<10}{stage["wall_seconds"]:>8.2f}'
+                         f'{stage["cpu_seconds"]:>8.2f}'
+                         f'{stage["read_bytes"] / 1e6:>9.1f}'
+                         f'{stage["written_bytes"] / 1e6:>9.1f}' +
+                         ''.join(f'{stage.get(col, 0):>7}'
+                                 for col in self.COLUMNS))
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        '''Returns all metrics in Prometheus text exposition format.'''
+        report  = self.report()
+        metrics = {'wall_seconds':  'Wall time spent in stage',
+                   'cpu_seconds':   'CPU time spent in stage',
+                   'read_bytes':    'Bytes read in stage',
+                   'written_bytes': 'Bytes written in stage'}
+        lines   = []
+        for key, help_text in metrics.items():
+            lines += [f'# HELP mp3cleaner_stage_{key} {help_text}',
+                      f'# TYPE mp3cleaner_stage_{key} gauge']
+            lines += [f'mp3cleaner_stage_{key}{{stage="{name}"}} {stage[key]}'
+                      for name, stage in self.stages.items()]
+
+        lines += ['# HELP mp3cleaner_stage_events Things done in stage',
+                  '# TYPE mp3cleaner_stage_events gauge']
+        lines += [f'mp3cleaner_stage_events{{stage="{name}",event="{key}"}} '
+                  f'{val}' for name, stage in self.stages.items()
+                  for key, val in stage.items() if key not in metrics]
+
+        lines += ['# HELP mp3cleaner_peak_rss_bytes Peak resident memory',
+                  '# TYPE mp3cleaner_peak_rss_bytes gauge',
+                  f'mp3cleaner_peak_rss_bytes {report["peak_rss_kib"] * 1024}',
+                  '# HELP mp3cleaner_last_run_timestamp_seconds End of run',
+                  '# TYPE mp3cleaner_last_run_timestamp_seconds gauge',
+                  f'mp3cleaner_last_run_timestamp_seconds '
+                  f'{report["finished"]}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filepath):
+        '''
+        Writes metrics to a file: in Prometheus text format if its name
+        ends with .prom (for node exporter's textfile collector), as JSON
+        otherwise. The file is replaced at once, never seen half-written.
+        '''
+        if filepath.endswith('.prom'):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.report(), indent=1)
 
-    curr_file             += 1
-    len_of_total_files_str = len(str(total_n_of_files))
-    format_pre_str         = '{:' + str(len_of_total_files_str) + '}'
-    curr_file_formatted    = format_pre_str.format(curr_file)
+        with open(f'{filepath}.tmp', 'w') as f:
+            f.write(content)
+        replace(f'{filepath}.tmp', filepath)
 
-    print(f' [{curr_file_formatted}/{total_n_of_files}]  {filename}')
 
+class TitleCache:
+    '''
+    Persistent cache of corrected tag values, kept in sqlite database.
+
+    Maps raw (lowercased) tag values to their final form, after
+    capitalization and regex corrections. Entries are stored together
+    with a fingerprint of the settings that produced them, so changing
+    those settings never brings back stale corrections. Once there are
+    more than max_size entries, least recently used ones are dropped.
+    Empty db_path keeps the cache in memory, for the current run only.
+    Changes to a read only cache are dropped when it is closed.
+    '''
+    def __init__(self, db_path, max_size, fingerprint, read_only=False):
+        if db_path:
+            db_path = path.expanduser(db_path)
+            if read_only and not path.isfile(db_path):
+                db_path = ''
+            else:
+                makedirs(path.dirname(db_path) or '.', exist_ok=True)
+        self.db          = sqlite3.connect(db_path or ':memory:')
+        self.read_only   = read_only
+        self.max_size    = max_size
+        self.fingerprint = fingerprint
+        self.hits        = 0
+        self.misses      = 0
+        self.db.execute(
+          'CREATE TABLE IF NOT EXISTS titles (fingerprint TEXT, raw TEXT, '
+          'cleaned TEXT, used REAL, PRIMARY KEY (fingerprint, raw))')
+
+    def get_many(self, raw_vals):
+        '''Returns a dict of cached corrections for given raw values.'''
+        found = {}
+        for i in range(0, len(raw_vals), 500):
+            chunk = raw_vals[i:i+500]
+            query = ('SELECT raw, cleaned FROM titles WHERE fingerprint = ? '
+                     f'AND raw IN ({",".join("?" * len(chunk))})')
+            found.update(self.db.execute(query, [self.fingerprint, *chunk]))
+
+        self.db.executemany(
+          'UPDATE titles SET used = ? WHERE fingerprint = ? AND raw = ?',
+          [(time(), self.fingerprint, raw) for raw in found])
+        self.hits   += len(found)
+        self.misses += len(raw_vals) - len(found)
+        return found
+
+    def put_many(self, corrections):
+        '''Stores new corrections, drops least recently used overflow.'''
+        self.db.executemany(
+          'INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?)',
+          [(self.fingerprint, raw, cleaned, time())
+           for raw, cleaned in corrections.items()])
+        self.db.execute(
+          'DELETE FROM titles WHERE rowid IN (SELECT rowid FROM titles '
+          'ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def commit(self):
+        if not self.read_only:
+            self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class ImageCache:
+    '''
+    Persistent, content-addressed store of compressed images.
+
+    Every image the program compresses is stored in cache_dir, under a
+    SHA-1 digest of its original bytes and of compression settings,
+    together with CPU time its compression took. The same scan showing
+    up again, in another edition of an album or in a re-download, gets
+    a reflink (or a copy) of the stored result instead of being
+    compressed again, and bytes and CPU time that saves are summed up.
+    Images compression leaves as they are get recorded only. Once
+    stored images take more than max_size bytes, least recently used
+    ones are dropped. Lookups and stores are safe from worker threads,
+    the index is written by commit, in the thread that made the cache.
+    '''
+    def __init__(self, cache_dir, max_size, fingerprint):
+        self.dir         = path.expanduser(cache_dir)
+        makedirs(self.dir, exist_ok=True)
+        self.db          = sqlite3.connect(f'{self.dir}/index.db')
+        self.max_size    = max_size
+        self.fingerprint = fingerprint.encode()
+        self.lock        = Lock()
+        self.added       = {}
+        self.used        = set()
+        self.hits        = 0
+        self.saved_bytes = 0
+        self.saved_cpu   = 0.0
+        self.db.execute(
+          'CREATE TABLE IF NOT EXISTS images (digest TEXT PRIMARY KEY, '
+          'ext TEXT, in_size INTEGER, out_size INTEGER, cpu_seconds REAL, '
+          'used REAL)')
+        self.entries = {row[0]: row[1:] for row in self.db.execute(
+                          'SELECT digest, ext, in_size, out_size, '
+                          'cpu_seconds FROM images')}
+
+    def digest(self, img_path):
+        img_hash = hashlib.sha1(self.fingerprint)
+        with open(img_path, 'rb') as f:
+            img_hash.update(f.read())
+        return img_hash.hexdigest()
+
+    def restore(self, digest, img_path):
+        '''
+        Puts stored result of compressing an image in place of the image,
+        returns its path, or None if nothing is stored under the digest.
+        '''
+        entry = self.entries.get(digest)
+        if entry is None:
+            return None
+        ext, in_size, out_size, cpu_seconds = entry
+
+        out_path = img_path
+        if ext:  # the image didn't stay as it was
+            out_path = path.splitext(img_path)[0] + ext
+            try:
+                place_file(f'{self.dir}/{digest}{ext}', out_path, 'reflink')
+            except FileNotFoundError:  # removed from cache_dir by hand
+                return None
+            if out_path != img_path:
+                remove(img_path)
+
+        with self.lock:
+            self.used.add(digest)
+            self.hits        += 1
+            self.saved_bytes += in_size
+            self.saved_cpu   += cpu_seconds
+        return out_path
+
+    def store(self, digest, in_size, out_path, changed, cpu_seconds):
+        '''
+        Stores result of compressing an image of in_size bytes, which went
+        to out_path, or just records that compression left it unchanged.
+        '''
+        ext = path.splitext(out_path)[1] if changed else ''
+        if ext:
+            place_file(out_path, f'{self.dir}/{digest}{ext}', 'reflink')
+        entry = (ext, in_size, stat(out_path).st_size, cpu_seconds)
+        with self.lock:
+            self.added[digest] = self.entries[digest] = entry
+
+    def commit(self):
+        '''Writes down new and used entries, drops overflow.'''
+        with self.lock:
+            added, self.added = self.added, {}
+            used,  self.used  = self.used, set()
+        now = time()
+
+        self.db.executemany(
+          'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+          [(digest, *entry, now) for digest, entry in added.items()])
+        self.db.executemany('UPDATE images SET used = ? WHERE digest = ?',
+                            [(now, digest) for digest in used])
+
+        total_size = 0
+        for digest, ext, out_size in self.db.execute(
+              "SELECT digest, ext, out_size FROM images WHERE ext != '' "
+              'ORDER BY used DESC').fetchall():
+            total_size += out_size
+            if total_size > self.max_size:
+                self.db.execute('DELETE FROM images WHERE digest = ?',
+                                (digest,))
+                self.entries.pop(digest, None)
+                try:
+                    remove(f'{self.dir}/{digest}{ext}')
+                except FileNotFoundError:
+                    pass
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def tag_regexes(s):
+    '''
+    Builds ordered table of tag value corrections, based on settings.
 
-def eval_total_files():
-    '''Counts all files to be edited in the base_dir directory'''
-    n = 0
+    Keys are regex patterns, values are their replacements. They are
+    applied in order, after capitalization.
+    '''
+    regexes = {
+        'AiN\'t':                                      'Ain\'t',
+        'dN\'t':                                       'dn\'t',
+        'DoN\'t':                                      'Don\'t',
+        r'(?<=\d)Am(?=\b)':                            'AM',
+        r'\bEp\b(?!\.)':                                'EP',
+        r'\bMc\b':                                     'MC',
+        r'(?<=\d)Pm(?=\b)':                            'PM',
+    }
 
-    for (root, dirs, files) in walk(s.base_dir):
-        if not s.broken_dir in root and not s.notmp3_dir in root:
-            n += len(files)
+    if s.del_bonus_track:
+        regexes[' ?[\[\(] ?[Bb]onus [Tt]rack ?[\]\)]']      = ''
 
-    if not n:
-        raise ValueError(
-          f'No mp3 files found in {s.base_dir}. Add something '
-          ' (or change the path in program settings) and then start '
-          'the program. Exiting...')
-    return n
+    if s.del_explicit:
+        regexes[' ?[\[\(] ?[Ee]xplicit ?[\]\)]']            = ''
 
+    if s.del_lp:
+        regexes[r' ?[\(\[]?\b[Ll][Pp]\b ?[\)\]]?']          = ''
 
-def tag_to_file(filepath, category='single', **kwargs):
-    '''
-    Reads tag information and saves it to a file. 
+    if s.del_orig_mix:
+        regexes[' ?[\[\(] ?[Oo]riginal [Mm]ix ?[\]\)]']     = ''
 
-    Extracts file information from an mp3 file, does minor corrections
-    and appends extracted yaml stripe to tag_changes_file. The 'category'
-    argument can be either 'single' or 'album', indicating which type
-    of file is being worked (album needs few extra steps). One kwarg,
-    'album artist', passes extra tag field information for album mp3s.
-    '''
-    def tag_to_str(tag):
-        '''Simple string cleaner'''
-        if tag is None:
-            return ''
-        tag = str(tag)
-        if tag == parsed.tag.title:
-            if s.roman_to_arabic:
-                tag = romantoarabic(tag)
-        tag = tag.strip().lower()
-        return tag
+    if s.del_produced:
+        regexes[' ?[\(\[] ?[Pp]rod(?:\.|uced)(?: [Bb]y|)'
+        '[^\)\]\n]+ ?[\)\]]']                               = ''
 
-    if category == 'album' and not kwargs: (
-        'For "album" category, you also need to pass album_artist keyword '
-        'argument like so:\n tag_to_file(path/to/file, "album", '
-        'album_artist="some string". Exiting...')
+    if s.chn_edit:
+        regexes[' ?[\(\[] ?[Ee]dit ?[\)\]]']                = s.chn_edit
 
-    file = re.search('(?<=[/])[^/]+$', filepath)[0]
+    if s.chn_extended:
+        regexes[' ?[\[\(] ?[Ee]xtended ?[\]\)]']            = s.chn_extended
 
-    with NoStdErr():
-        parsed = eyed3.load(filepath)
-        date = str(tag_to_str(parsed.tag.getBestDate()))[:4]
-    artist = tag_to_str(parsed.tag.artist)
-    album  = tag_to_str(parsed.tag.album)
-    title  = tag_to_str(parsed.tag.title)
+    if s.chn_extended_mix:
+        regexes[' ?[\[\(]? ?[Ee]xtended [Mm]ix ?[\]\)]?']   = s.chn_extended_mix
 
-	# Always a two-item tuple (track num, total tracks), Nones if
-    # no data.
-    if parsed.tag.track_num[0]:
-        track_num = str(parsed.tag.track_num[0])
-    else:
-        try:
-            track_num = re.search('\d\d?', file[:5])[0]
-        except (IndexError, TypeError):
-            track_num = ''
-
-    if re.search(s.feat_rgx, artist):
-        artist = re.sub(s.feat_rgx, ',', artist)
-
-    if re.search(s.feat_rgx, title):
-        extra_artists = re.search(f'{s.feat_rgx}.+', title)[0]
-        extra_artists = re.sub(s.feat_rgx, '', extra_artists)
-        extra_artists = extra_artists.rstrip(']) ')
-        extra_artists = extra_artists.replace(', ', ',')
-        title         = re.sub(f'{s.feat_rgx}.+$', '', title)
-        artist        = artist + ',' + extra_artists
-
-    if category == 'album' and not artist_has_comma:
-        artist = artist.replace(', ', ',')
-    ep_pre_rgx = ' [\(\[]?[Ee][Pp][\\)\]]?$'
-
-    if category == 'album' and re.search(ep_pre_rgx, album):
-        album = re.sub(ep_pre_rgx, '', album)
-
-    if s.ep_eval:
-        ep_conditions = (category == 'album'
-                         and album_time < s.ep_max_length
-                         and not re.search(r'\b[Ee][Pp]\b(?=[^\.])', album))
-        if ep_conditions:
-            album = f'{album} EP'
-
-    title = re.sub('"', '\'', title)
-
-    stripe = (f'  artist: "{artist}"\n'
-			  f'  album: "{album}"\n'
-			  f'  title: "{title}"\n'
-			  f'  date: "{date}"\n'
-			  f'  track no: "{track_num}"\n'
-			  f'  path: "{filepath}"\n')
-    if 'album_artist' in kwargs:
-        a_artist = kwargs["album_artist"]
-        a_artist = a_artist.strip().lower()
-        stripe = f'  album artist: \"{a_artist}\"\n' + stripe
-
-    with open(s.tag_changes_file, 'a+') as f:
-        f.write(f'-\n{stripe}')
+    if s.chn_instrumental:
+        regexes[' ?[\[\(] ?[Ii]nstr(?:\.|umental) ?[\]\)]'] = s.chn_instrumental
 
+    if s.chn_live:
+        regexes[' ?[\(\[] ?[Ll]ive ?[\)\]]']                = s.chn_live
 
-def romantoarabic(title):
-    '''Converts low Roman numeral strings to Arabic numeral stirngs.'''
-    romans = {'XX':'20', 'XIX':'19', '18':'XVIII', 'XVII':'17', 'XVI':'16', 
-    		  'XV:':'15:', 'XV':'15', 'XIV:':'14:', 'XIV':'14', 'XIII:':'13:',
-    		  'XIII':'13', 'XII:':'12:', 'XII':'12', 'XI:':'9:', 'XI':'9',
-    		  ' X ': ' 10 ', 'IX:':'9:', 'IX':'9', 'VIII:':'8:', 'VIII':'8',
-    		  'VII:':'7:', 'VII':'7', 'VI:':'6:', 'VI':'6', ' V ':' 5 ',
-    		  'IV:':'4:', 'IV':'4', 'V:':'5:', 'III:':'3:', 'III':'3',
-    		  'II:':'2:', 'II':'2'}
-
-    for roman in romans:
-        if roman in title:
-            title = re.sub(roman, romans[roman], title)
+    if s.chn_mix:
+        regexes[' ?[\[\(] ?(.+) [Mm]ix ?[\]\)]']            = s.chn_mix
 
-    title = re.sub(" V$", " 5", title)
-    return title
+    if s.chn_ost:
+        regexes[' Ost']                                     = s.chn_ost
 
+    if s.chn_orig_sdtrack:
+        regexes[' ?[\[\(]? ?(?:[Oo]riginal )(?:[Mm]ovie |)'
+        '(?:[Mm]otion |)(?:[Pp]icture |)[Ss]oundtrack'
+        ' ?(?:[Aa]lbum|)[\]\)]?']                           = s.chn_orig_sdtrack
 
-def nlp_capitalize(title):
-    '''
-    The Chicago Manual of Style capitalization instructions for Spacy.
+    if s.chn_cover:
+        regexes['[\[\(] ?(\w+) Cover ?[\]\)]']              = s.chn_cover
 
-    Titlechaser was stripped and converted into a function for purposes
-    of this program. Below is its original address:
-    https://github.com/tummychow/titlechaser
-    '''
-    title = str(title)
-    title = title.replace('\\', '/')
+    if s.chn_remix:
+        regexes['[Rr]emix']                                 = s.chn_remix
 
-    TO_CAPITALIZE = {'NN','NNS','NNP','NNPS','PRP','PRP$','WP','WP$','JJ',
-    				 'JJR','JJS','MD','VB','VBD','VBG','VBN','VBP','VBZ','RB',
-    				 'RBR','RBS','RP','WRB'}
+    if s.chn_remix2:
+        regexes[' ?[\[\(] ?[Rr]emix ?[\]\)]']               = s.chn_remix2
 
-    def capitalize_token(arg, idx):
-        tok = arg[idx]
-        return (
-            (idx == 0 or idx == len(arg)-1) or
-            (tok.tag_ in TO_CAPITALIZE) or
-            (tok.tag_ == 'IN' and tok.dep_ in {'mark', 'complm'}) or
-            (idx > 0 and idx < len(arg)-1 and arg[idx+1].tag_ == 'HYPH'
-              and arg[idx-1].tag_ != 'HYPH'))
+    if s.chn_remix3:
+        regexes[' ?[\[\(] ?(.+) [Rr]emix ?[\]\)]']          = s.chn_remix3
 
-    def titlecase_tokens(arg):
-        ret = []
-        for idx, tok in enumerate(arg):
-            ret.append(tok.orth_.capitalize() if capitalize_token(arg, idx)
-                       else tok.orth_)
-            ret.append(tok.whitespace_)
-        return ret
+    if s.chn_reprise:
+        regexes['[Rr]eprise']                               = s.chn_reprise
 
-    nlp    = spacy.load('en')
-    output = titlecase_tokens(nlp(title))
-    title  = ''.join(output)
-    return title
+    if s.chn_version:
+        regexes[' ?[\(\[] ?(.+) [Vv]ersion ?[\)\]]']        = s.chn_version
 
+    regexes[' {2,}']                                        = ' '
 
-def rename_img(dir_path, filename, replace_with):
-    rgx_search        = "^.+(?=(?:.jpg|.png))"
-    renamed_file      = re.sub(rgx_search, replace_with, filename)
-    renamed_file_path = f'{dir_path}/{renamed_file}'
-    renames(f'{dir_path}/{filename}', renamed_file_path)
+    return regexes
 
 
+def compile_rules(regexes):
+    '''
+    Compiles correction table into a list of (pattern, replacement) rules.
 
-# Startup actions:
-# * checks if important fields are properly set in settings.py
-# * run mp3val if enabled
-# * verifies if any blacklisted program is running, prevents running
-#   if so
-# * prepares files and directories for operations
-print('MP3 Cleaner started, reading files...')
+    Neighbouring rules which replace plain text with plain text are
+    merged into one alternation, one pass over the value instead of
+    several, as long as no rule can create, break or overlap a match
+    of another one from the same group. Otherwise order of rules, and
+    so the result, stays exactly the same as with the table itself.
+    '''
+    def texts_overlap(a, b):
+        if not a or not b or a in b or b in a:
+            return True
+        return any(a.endswith(b[:i]) or b.endswith(a[:i])
+                   for i in range(1, min(len(a), len(b))))
+
+    def merge(group):
+        if len(group) == 1:
+            (pattern, repl), = group.items()
+            return re.compile(re.escape(pattern)), repl
+        pattern = '|'.join(re.escape(p) for p in group)
+        return re.compile(pattern), lambda m: group[m.group(0)]
+
+    rules = []
+    group = {}
+
+    for pattern, repl in regexes.items():
+        if re.search(r'[\\.^$*+?{}\[\]()|]', pattern + repl):
+            if group:
+                rules.append(merge(group))
+                group = {}
+            rules.append((re.compile(pattern), repl))
+            continue
 
-if not all([s.base_dir, s.dest_dir, s.tag_changes_file, s.feat_rgx]) or \
-   not any([s.write_to_v1, s.write_to_v2]):
-    print('Please fill all the "file settings" fields in settings.py before '
-          'running this program')
-    sys.exit()
+        conflicts = any(texts_overlap(pattern, p) or
+                        texts_overlap(pattern, r) or
+                        texts_overlap(repl, p) for p, r in group.items())
+        if conflicts:
+            rules.append(merge(group))
+            group = {}
+        group[pattern] = repl
 
-if s.app_blacklist:
-    for app in s.app_blacklist:
-        check = popen(f'ps aux | grep -i {app} | grep -v grep | wc -l')
-        check = check.read().strip()
-        check = int(check)
+    if group:
+        rules.append(merge(group))
+    return rules
 
-        if check:
-            raise ValueError(
-              f'Please close {app} first before running the program. '
-              'Exiting...')
 
-makedirs(f'{s.base_dir}/{s.broken_dir}', exist_ok=True)
-with open(s.tag_changes_file, 'w') as f:
-    f.write('')
+def correct_values(vals, rules):
+    '''
+    Runs compiled correction rules on a list of capitalized tag values.
 
+    Values are corrected together, one per line, so every rule scans
+    them in one go. None of the patterns can match a line break, so
+    each value ends up exactly as if it was corrected on its own.
+    '''
+    tag_string = '\n'.join(vals)
+    for pattern, repl in rules:
+        tag_string = pattern.sub(repl, tag_string)
+    tag_string = FIRST_LETTER_RGX.sub(lambda m: m.group(0).upper(),
+                                      tag_string)
+    return tag_string.split('\n') if vals else []
 
-# Move non-mp3 albums to notmp3_dir
-dirs = [d for d in listdir(s.base_dir) if d != s.broken_dir and
-                                          d != s.notmp3_dir]
 
+def benchmark_rules(corpus_path, regexes, rules):
+    '''
+    Compares old and new way of running corrections on a tag corpus.
+
+    Corpus is any tag changes file, or just lines of its fields. Its
+    values are recapitalized the way it happens without nlp, then
+    corrected both the old way, with every regex from the table
+    recompiled and run over the whole text, and with compiled rules,
+    once per unique value. Prints both timings,
+    exits with an error if results differ in any way.
+    '''
+    try:
+        with open(corpus_path) as f:
+            fields = [parse_field(line) for line in f
+                      if ': ' in line and line.strip()[:1] != '-']
+    except ValueError as err:
+        sys.exit(f'Error: {err} in {corpus_path}. Exiting...')
+    vals = [val.lower().title() for key, val in fields
+            if key != 'path' and val]
+    if not vals:
+        sys.exit(f'No tag values found in {corpus_path}. Exiting...')
+
+    re.purge()
+    start      = perf_counter()
+    tag_string = '\n'.join(vals)
+    for key, val in regexes.items():
+        tag_string = re.sub(key, val, tag_string)
+    tag_string = re.sub(r'(?:^|(?<="))\w', lambda m: m.group(0).upper(),
+                        tag_string, flags=re.M)
+    old_vals   = tag_string.split('\n')
+    old_time   = perf_counter() - start
+
+    start      = perf_counter()
+    uniq_vals  = list(dict.fromkeys(vals))
+    corrected  = dict(zip(uniq_vals, correct_values(uniq_vals, rules)))
+    new_vals   = [corrected[val] for val in vals]
+    new_time   = perf_counter() - start
+
+    print(f'{len(vals)} values ({len(uniq_vals)} unique), '
+          f'{len(regexes)} regexes compiled into {len(rules)} rules')
+    print(f' old, whole text:     {old_time:.4f}s')
+    print(f' new, unique values:  {new_time:.4f}s')
+
+    differences = [(old, new) for old, new in zip(old_vals, new_vals)
+                   if old != new]
+    for old, new in differences:
+        print(f' difference: {old} != {new}')
+    if differences:
+        sys.exit(1)
+    print(' results are identical')
+
+
+class TreeIndex:
+    '''
+    In-memory index of all files and directories below root directory.
+
+    The whole tree is read in one scandir pass, with file sizes. Stages
+    query the index instead of listing, globbing and walking the tree
+    again, and every move or removal the program does goes through it,
+    so it stays current without rescanning anything. Like glob, queries
+    skip hidden files and directories unless asked for them.
+
+    A virtual index never touches the tree: moves and removals only
+    change the index and get logged, with paths the files really have.
+    Real ones are counted in given metrics. Given names, the index only
+    covers those items of root directory, the rest of it stays unseen.
+    '''
+    def __init__(self, root, virtual=False, metrics=None, names=None):
+        self.root    = root
+        self.entries = {}  # dir path: {name: file size, None for dirs}
+        self.virtual = virtual
+        self.metrics = metrics or Metrics()
+        self.origins = {}  # virtual path of a moved item: its real path
+        self.log     = []  # operations a virtual index stood in for
+        self.scan(root, names)
+
+    def scan(self, dir_path, only=None):
+        '''
+        Adds a directory and everything below it to the index, or just
+        items of it named in only.
+        '''
+        stack = [dir_path]
+        while stack:
+            curr_dir = stack.pop()
+            names    = self.entries[curr_dir] = {}
+            with scandir(curr_dir) as dir_entries:
+                for entry in dir_entries:
+                    if only is not None and curr_dir == dir_path and \
+                       entry.name not in only:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        names[entry.name] = None
+                        stack.append(entry.path)
+                    else:
+                        names[entry.name] = entry.stat().st_size
+
+    def listdir(self, dir_path, hidden=True):
+        return [name for name in self.entries.get(dir_path, {})
+                if hidden or name[0] != '.']
+
+    def files(self, dir_path, hidden=False):
+        return [name for name, size in self.entries.get(dir_path, {}).items()
+                if size is not None and (hidden or name[0] != '.')]
+
+    def subdirs(self, dir_path, hidden=False):
+        return [name for name, size in self.entries.get(dir_path, {}).items()
+                if size is None and (hidden or name[0] != '.')]
+
+    def walk_files(self, dir_path, hidden=False):
+        '''Returns paths of all files below a directory.'''
+        found = [f'{dir_path}/{name}'
+                 for name in self.files(dir_path, hidden)]
+        for sub in self.subdirs(dir_path, hidden):
+            found.extend(self.walk_files(f'{dir_path}/{sub}', hidden))
+        return found
+
+    def is_dir(self, dir_path):
+        return dir_path in self.entries
+
+    def size(self, file_path):
+        parent, name = path.split(file_path)
+        return self.entries[parent][name]
+
+    def add(self, file_path):
+        '''Indexes a file created by an external program.'''
+        parent, name = path.split(file_path)
+        self._add_dir(parent)
+        self.entries[parent][name] = stat(file_path).st_size
+
+    def discard(self, item_path):
+        '''Drops a file or directory (with its content) from index.'''
+        parent, name = path.split(item_path)
+        self.entries.get(parent, {}).pop(name, None)
+        for dir_path in self._dirs_below(item_path):
+            del self.entries[dir_path]
+
+    def real_path(self, item_path):
+        '''Returns path an item really has, under its virtual path.'''
+        head = item_path
+        while self.origins and head.startswith(self.root):
+            if head in self.origins:
+                return self.origins[head] + item_path[len(head):]
+            head = path.dirname(head)
+        return item_path
+
+    def rename(self, src_path, dest_path):
+        '''
+        Moves file or directory like os.renames, updates the index.
+
+        Just like os.renames, removes directories left empty by the
+        move, so they are dropped from the index as well.
+        '''
+        if src_path == dest_path:
+            return
+        if self.virtual:
+            real_src = self.real_path(src_path)
+            self.log.append({'op': 'move', 'src': real_src,
+                             'dest': dest_path})
+            self.origins[dest_path] = real_src
+        else:
+            renames(src_path, dest_path)
+            self.metrics.count('moves')
+
+        parent, name = path.split(src_path)
+        size         = self.entries[parent].pop(name)
+        moved_dirs   = self._dirs_below(src_path)
+
+        if dest_path.startswith(f'{self.root}/'):
+            dest_parent, dest_name = path.split(dest_path)
+            self._add_dir(dest_parent)
+            self.entries[dest_parent][dest_name] = size
+            for dir_path in moved_dirs:
+                moved_path = dest_path + dir_path[len(src_path):]
+                self.entries[moved_path] = self.entries.pop(dir_path)
+        else:
+            for dir_path in moved_dirs:
+                del self.entries[dir_path]
+
+        while parent in self.entries and (not self.entries[parent]
+                                          if self.virtual
+                                          else not path.isdir(parent)):
+            self.discard(parent)
+            parent = path.dirname(parent)
+
+    def remove(self, file_path):
+        if self.virtual:
+            self.log.append({'op': 'delete',
+                             'path': self.real_path(file_path)})
+        else:
+            remove(file_path)
+            self.metrics.count('deletes')
+        self.discard(file_path)
+
+    def rmdir(self, dir_path):
+        if self.virtual:
+            self.log.append({'op': 'delete',
+                             'path': self.real_path(dir_path)})
+        else:
+            rmdir(dir_path)
+            self.metrics.count('deletes')
+        self.discard(dir_path)
+
+    def copy(self, src_path, dest_path, mode):
+        '''Logs a copy of a file made outside of the tree, in given mode.'''
+        self.log.append({'op': 'copy', 'mode': mode,
+                         'src': self.real_path(src_path), 'dest': dest_path})
+
+    def rewritten(self, src_path, dest_path):
+        '''Indexes a file rewritten by an external program, maybe renamed.'''
+        if self.virtual:
+            self.log.append({'op': 'compress',
+                             'path': self.real_path(src_path)})
+            if dest_path != src_path:
+                self.rename(src_path, dest_path)
+            return
+        self.discard(src_path)
+        self.add(dest_path)
+
+    def _add_dir(self, dir_path):
+        if dir_path in self.entries or not dir_path.startswith(self.root):
+            return
+        parent, name = path.split(dir_path)
+        self._add_dir(parent)
+        self.entries.setdefault(parent, {})[name] = None
+        self.entries[dir_path] = {}
+
+    def _dirs_below(self, dir_path):
+        '''
+        Returns a directory with all directories below it, found through
+        entries of their parents, so only the directory's own subtree
+        gets visited. A file has none.
+        '''
+        if dir_path not in self.entries:
+            return []
+        found = [dir_path]
+        for curr_dir in found:
+            found.extend(f'{curr_dir}/{name}'
+                         for name, size in self.entries[curr_dir].items()
+                         if size is None and
+                         f'{curr_dir}/{name}' in self.entries)
+        return found
+
+
+class Manifest:
+    '''
+    Persistent record of files the program has already worked on.
+
+    For every mp3 it keeps size, modification time and a hash of its
+    audio frames, together with what was done to it: validation, tag
+    extraction (with a snapshot of extracted tags) and the final move.
+    Files which were copied to dest_dir instead of moved stay recorded
+    where they are, as exported, so they aren't cleaned again.
+    Compressed images are recorded by size and modification time only.
+    Stages ask the manifest first and skip files it vouches for, so
+    rerunning the program over a tree it has seen before is cheap.
+    Files renamed outside of the program are still recognized, by size
+    and audio hash. Tracks found in dest_dir are indexed separately, by
+    size, modification time, audio size and (once needed) audio hash,
+    to find duplicates without reading the whole library every run.
+    With trust set to False, nothing is skipped, but
+    everything is recorded anew. Empty db_path keeps the manifest in
+    memory, without hashing anything, for the current run only. A read
+    only manifest is consulted, but records nothing.
+    '''
+    def __init__(self, db_path, trust=True, read_only=False):
+        if db_path:
+            db_path = path.expanduser(db_path)
+            if read_only and not path.isfile(db_path):
+                db_path = ''
+            else:
+                makedirs(path.dirname(db_path) or '.', exist_ok=True)
+        self.db        = sqlite3.connect(db_path or ':memory:')
+        self.hashing   = bool(db_path) and not read_only
+        self.trust     = trust
+        self.read_only = read_only
+        self.hashes  = {}
+        self.db.execute(
+          'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+          'size INTEGER, mtime INTEGER, audio_hash TEXT, '
+          'validated INTEGER, tags TEXT, moved INTEGER)')
+        self.db.execute(
+          'CREATE INDEX IF NOT EXISTS files_size ON files (size)')
+        self.db.execute(
+          'CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, '
+          'size INTEGER, mtime INTEGER)')
+        self.db.execute(
+          'CREATE TABLE IF NOT EXISTS library (path TEXT PRIMARY KEY, '
+          'size INTEGER, mtime INTEGER, audio_size INTEGER, '
+          'audio_hash TEXT)')
+
+    def entry(self, filepath):
+        '''
+        Returns (validated, tags) recorded for unchanged file, or None.
+        '''
+        if not self.trust:
+            return None
+
+        file_stat = stat(filepath)
+        row = self.db.execute(
+          'SELECT size, mtime, validated, tags FROM files '
+          'WHERE path = ? AND moved = 0', (filepath,)).fetchone()
+        if row and row[:2] == (file_stat.st_size, file_stat.st_mtime_ns):
+            return row[2], row[3] and json.loads(row[3])
+
+        if not self.hashing:
+            return None
+        candidates = self.db.execute(
+          'SELECT path, audio_hash, validated, tags FROM files '
+          'WHERE size = ? AND moved = 0', (file_stat.st_size,)).fetchall()
+        if not candidates:
+            return None
+
+        file_hash = self.audio_hash(filepath)
+        for other_path, other_hash, validated, tags in candidates:
+            if other_hash == file_hash:
+                self.db.execute(
+                  'INSERT OR REPLACE INTO files '
+                  'SELECT ?, size, ?, audio_hash, validated, tags, moved '
+                  'FROM files WHERE path = ?',
+                  (filepath, file_stat.st_mtime_ns, other_path))
+                return validated, tags and json.loads(tags)
+        return None
+
+    def is_validated(self, filepath, level=1):
+        entry = self.entry(filepath)
+        return bool(entry and entry[0] >= level)
+
+    def tags(self, filepath):
+        entry = self.entry(filepath)
+        return entry[1] if entry else None
+
+    def record(self, filepath, validated=None, tags=None):
+        '''Records current state of a file, with what was done to it.'''
+        if self.read_only:
+            return
+        file_stat = stat(filepath)
+        row = self.db.execute(
+          'SELECT size, mtime, audio_hash, validated, tags FROM files '
+          'WHERE path = ?', (filepath,)).fetchone()
+        if not row or row[:2] != (file_stat.st_size, file_stat.st_mtime_ns):
+            row = (None, None, None, 0, None)
+        if validated is None:
+            validated = row[3]
+        tags = json.dumps(tags) if tags is not None else row[4]
+
+        self.db.execute(
+          'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, 0)',
+          (filepath, file_stat.st_size, file_stat.st_mtime_ns,
+           row[2] or self.audio_hash(filepath), validated, tags))
+
+    def record_moved(self, src_path, dest_path):
+        '''Re-records a file after its tags were saved and it got moved.'''
+        if self.read_only:
+            return
+        file_stat = stat(dest_path)
+        row       = self.db.execute('SELECT validated FROM files '
+                                    'WHERE path = ?', (src_path,)).fetchone()
+        self.db.execute('DELETE FROM files WHERE path = ?', (src_path,))
+        self.db.execute(
+          'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, NULL, 1)',
+          (dest_path, file_stat.st_size, file_stat.st_mtime_ns,
+           self.audio_hash(dest_path), row[0] if row else 1))
+
+    def record_exported(self, src_path, dest_path=None):
+        '''
+        Records a file which stayed where it was, while its copy with tags
+        saved went to dest_path. Without dest_path, the file is recorded
+        as left out of dest_dir for good, as broken or duplicate files
+        are when nothing gets moved.
+        '''
+        if self.read_only:
+            return
+        file_stat = stat(src_path)
+        row       = self.db.execute(
+                      'SELECT audio_hash, validated, tags FROM files '
+                      'WHERE path = ?', (src_path,)).fetchone() or \
+                    (None, 1, None)
+        self.db.execute(
+          'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, 2)',
+          (src_path, file_stat.st_size, file_stat.st_mtime_ns,
+           row[0] or self.audio_hash(src_path), row[1], row[2]))
+        if not dest_path:
+            return
+
+        file_stat = stat(dest_path)
+        self.db.execute(
+          'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, NULL, 1)',
+          (dest_path, file_stat.st_size, file_stat.st_mtime_ns,
+           self.audio_hash(dest_path), row[1]))
+
+    def is_exported(self, filepath):
+        '''
+        Tells if an unchanged file already has its copy in dest_dir, or was
+        left out of it for good.
+        '''
+        if not self.trust:
+            return False
+        file_stat = stat(filepath)
+        row = self.db.execute('SELECT size, mtime FROM files '
+                              'WHERE path = ? AND moved = 2',
+                              (filepath,)).fetchone()
+        return row == (file_stat.st_size, file_stat.st_mtime_ns)
+
+    def unexport(self, src_path, dest_path):
+        '''Undoes record_exported, once the copy is gone.'''
+        self.db.execute('DELETE FROM files WHERE path = ?', (dest_path,))
+        self.db.execute('UPDATE files SET moved = 0 '
+                        'WHERE path = ? AND moved = 2', (src_path,))
+
+    def has_image(self, img_path):
+        if not self.trust:
+            return False
+        file_stat = stat(img_path)
+        row = self.db.execute('SELECT size, mtime FROM images WHERE path = ?',
+                              (img_path,)).fetchone()
+        return row == (file_stat.st_size, file_stat.st_mtime_ns)
+
+    def record_image(self, img_path):
+        if self.read_only:
+            return
+        file_stat = stat(img_path)
+        self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?)',
+                        (img_path, file_stat.st_size, file_stat.st_mtime_ns))
+
+    def move(self, src_path, dest_path):
+        '''Re-keys entries after a file or directory got renamed.'''
+        for table in ('files', 'images'):
+            self.db.execute(
+              f'UPDATE OR REPLACE {table} SET path = ? || substr(path, ?) '
+              'WHERE path = ? OR substr(path, 1, ?) = ?',
+              (dest_path, len(src_path) + 1, src_path, len(src_path) + 1,
+               f'{src_path}/'))
+
+    def audio_hash(self, filepath):
+        if not self.hashing:
+            return None
+        return self.content_hash(filepath)
+
+    def content_hash(self, filepath):
+        '''
+        Returns audio hash of a file, the recorded one if the file hasn't
+        changed since. Hashes even when the manifest doesn't hash.
+        '''
+        if filepath in self.hashes:
+            return self.hashes[filepath]
+        file_stat = stat(filepath)
+        row = self.db.execute(
+          'SELECT size, mtime, audio_hash FROM files WHERE path = ?',
+          (filepath,)).fetchone()
+        if self.trust and row and row[2] and \
+           row[:2] == (file_stat.st_size, file_stat.st_mtime_ns):
+            return row[2]
+        self.hashes[filepath] = audio_hash(filepath)
+        return self.hashes[filepath]
+
+    def library(self):
+        '''
+        Returns {path: [size, mtime, audio size, audio hash]} of indexed
+        dest_dir tracks, hash being None for tracks never hashed.
+        '''
+        if not self.trust:
+            return {}
+        return {row[0]: list(row[1:])
+                for row in self.db.execute('SELECT * FROM library')}
+
+    def record_library(self, entries, gone=()):
+        '''Updates dest_dir index, drops entries of files that are gone.'''
+        if self.read_only:
+            return
+        self.db.executemany(
+          'INSERT OR REPLACE INTO library VALUES (?, ?, ?, ?, ?)',
+          [(track_path, *entry) for track_path, entry in entries.items()])
+        self.db.executemany('DELETE FROM library WHERE path = ?',
+                            [(track_path,) for track_path in gone])
+
+    def commit(self):
+        if not self.read_only:
+            self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class Journal:
+    '''
+    Write-ahead journal of the save and move stage, in JSON lines.
+
+    Every planned move, with tags to be saved, is written down and
+    flushed to disk before the first file is touched. Then moves are
+    marked done, a destination directory at a time. Original tags of
+    tracks are written down before they get overwritten, so that a
+    rollback can restore them. A run which gets interrupted leaves the
+    journal behind, so the next one can resume or roll back the stage.
+    Empty filepath disables the journal.
+    '''
+    def __init__(self, filepath):
+        self.filepath = path.expanduser(filepath) if filepath else ''
+        self.file     = None
+        self.lock     = Lock()
+
+    def exists(self):
+        return bool(self.filepath) and path.isfile(self.filepath)
+
+    def write(self, moves):
+        if not self.filepath:
+            return
+        makedirs(path.dirname(self.filepath) or '.', exist_ok=True)
+        self.file = open(self.filepath, 'w')
+        for move in moves:
+            self.file.write(json.dumps(move, ensure_ascii=False) + '\n')
+        self.sync()
+
+    def reopen(self):
+        '''Goes on writing to the journal of an interrupted run.'''
+        if self.exists():
+            self.file = open(self.filepath, 'a')
+
+    def mark_done(self, move_nums):
+        if not self.file:
+            return
+        with self.lock:
+            self.file.write(json.dumps({'done': move_nums}) + '\n')
+            self.sync()
+
+    def write_tags(self, originals):
+        '''
+        Writes down {move number: (ID3v2 tag, ID3v1 tag)} of files about
+        to get new tags, as tag_bytes returns them.
+        '''
+        if not self.file or not originals:
+            return
+        entry = {n: [base64.b64encode(tag).decode() for tag in tags]
+                 for n, tags in originals.items()}
+        with self.lock:
+            self.file.write(json.dumps({'tags': entry}) + '\n')
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        fsync(self.file.fileno())
+
+    def read(self):
+        '''
+        Returns planned moves, set of numbers of finished ones and
+        {move number: (ID3v2 tag, ID3v1 tag)} of files whose tags were
+        about to be saved.
+
+        A line cut short by a crash is ignored. Tags written down again
+        by a resumed run may be already saved ones, only the first ones
+        are kept.
+        '''
+        moves     = []
+        done      = set()
+        originals = {}
+        with open(self.filepath) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if 'done' in entry:
+                    done.update(entry['done'])
+                elif 'tags' in entry and 'src' not in entry:
+                    for n, tags in entry['tags'].items():
+                        originals.setdefault(int(n), tuple(
+                          base64.b64decode(tag) for tag in tags))
+                else:
+                    moves.append(entry)
+        return moves, done, originals
+
+    def remove(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.exists():
+            remove(self.filepath)
+
+
+def id3v2_size(header):
+    '''
+    Returns full size of ID3v2 tag (with padding and footer) from first
+    10 bytes of a file, 0 if there is no tag.
+    '''
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    size = 10 + ((header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 |
+                 (header[8] & 0x7f) << 7  | (header[9] & 0x7f))
+    if header[5] & 0x10:  # footer present
+        size += 10
+    return size
 
-def glob_notmp3(d):
-    notmp3_files = []
-    notmp3_formats = ['aac', 'aiff', 'alac', 'ape', 'flac', 'mpc', 'ogg', 'opus', 'wav', 'wma']  
-    for ext in notmp3_formats:
-        notmp3_files.extend(glob(f'{s.base_dir}/{d}/**/*.{ext}', recursive=True))
-    return notmp3_files
 
-for d in dirs:
-    dir_path = f'{s.base_dir}/{d}'
-    notmp3_files = glob_notmp3(d)
-    if notmp3_files:
-        print(f'"{d}" directory contains flac files, moving it to '
-              f'"{s.notmp3_dir}" directory')
-        renames(dir_path, f'{s.base_dir}/{s.notmp3_dir}/{d}')
+def audio_span(f):
+    '''
+    Returns (start, end) offsets of audio frames in an open mp3 file,
+    i.e. everything between ID3v2 and ID3v1 tags. Reads 13 bytes.
+    '''
+    f.seek(0)
+    start = id3v2_size(f.read(10))
+    end   = f.seek(0, 2)
+    if end - start >= 128:
+        f.seek(end - 128)
+        if f.read(3) == b'TAG':
+            end -= 128
+    return min(start, end), end
 
 
-# Test/repair all mp3 files, move broken, delete junk files
-base_dir_slashes = s.base_dir.count('/')
+def tag_bytes(filepath):
+    '''
+    Returns (ID3v2 tag, ID3v1 tag) of an mp3 file as they are on disk,
+    empty for a tag the file doesn't have.
+    '''
+    with open(filepath, 'rb') as f:
+        start, end = audio_span(f)
+        f.seek(0)
+        tag_v2 = f.read(start)
+        f.seek(end)
+        tag_v1 = f.read()
+    return tag_v2, tag_v1
 
-all_items = glob(f'{s.base_dir}/**/*', recursive=True) 
-all_files = [f for f in all_items if path.isfile(f)]
-mp3_files = [a for a in all_files if a[-4:] == '.mp3']
-jnk_files = [j for j in all_files if j[-4:] != '.jpeg' and
-                                     j[-4:] != '.jpg' and
-                                     j[-4:] != '.mp3' and
-                                     j[-4:] != '.png']
 
-for jnk_file in jnk_files:
-    remove(jnk_file)
+def restore_tags(filepath, tag_v2, tag_v1):
+    '''
+    Puts tags returned by tag_bytes back in an mp3 file, in place of
+    whatever tags it has now. The file is rewritten into a temporary
+    file next to it, which then replaces it.
+    '''
+    with open(filepath, 'rb') as src, \
+         NamedTemporaryFile('wb', dir=path.dirname(filepath),
+                            delete=False) as tmp_file:
+        start, end = audio_span(src)
+        tmp_file.write(tag_v2)
+        copy_range(src, tmp_file, start)
+        tmp_file.seek(len(tag_v2) + end - start)
+        tmp_file.truncate()
+        tmp_file.write(tag_v1)
+    copymode(filepath, tmp_file.name)
+    replace(tmp_file.name, filepath)
+
+
+def audio_size(filepath):
+    '''Returns size of audio frames of an mp3 file, tags left out.'''
+    with open(filepath, 'rb') as f:
+        start, end = audio_span(f)
+    return end - start
+
+
+def audio_hash(filepath):
+    '''
+    Hashes audio frames of an mp3 file, skipping ID3v2 and ID3v1 tags.
 
-if s.enable_mp3val:
-    print('mp3val enabled, fixing errors in files...')
+    Rewriting tags doesn't change the hash, so it identifies a track
+    no matter what its tags say. The file is memory-mapped and hashed
+    straight from page cache, with no copies in between, and the kernel
+    is told it's read sequentially, so it reads ahead.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
 
-for mp3_path in mp3_files:
-    if s.enable_mp3val:
-        run(['mp3val', '-f', '-nb', mp3_path], stdout=DEVNULL, stderr=DEVNULL)
+    with open(filepath, 'rb') as f:
+        start, end = audio_span(f)
+        if end > start:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise'):  # Python 3.8+
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    digest.update(view[start:end])
 
-    with NoStdErr():
-        parsed = eyed3.load(mp3_path)
-
-    if not parsed:
-        print((f'file {mp3_path} is broken, moving it to "{s.broken_dir}" '
-                'subdirectory'))
-        mp3_path_slashes = mp3_path.count('/')
-
-        if mp3_path_slashes   == base_dir_slashes + 1:  # single
-            renames(mp3_path, f'{s.base_dir}/{s.broken_dir}/')
-
-        elif mp3_path_slashes == base_dir_slashes + 2:  # album
-            dir_of_file = '/'.join(mp3_path.split('/')[-2:-1])
-            filename    = mp3_path.split('/')[-1]
-            renames(f'{s.base_dir}/{dir_of_file}/{filename}',
-                    f'{s.base_dir}/{s.broken_dir}/{dir_of_file}/{filename}')
-
-
-curr_file        = 0
-total_n_of_files = eval_total_files()
-files            = [name for name in listdir(s.base_dir)
-                    if not path.isdir(path.join(s.base_dir, name))]
-dirs             = [name for name in listdir(s.base_dir)
-                    if path.isdir(path.join(s.base_dir, name))
-                    and name != s.broken_dir
-                    and name != s.notmp3_dir]
-
-
-# Rename mp3 subdirs to enumerated CD dirs, move relevant imgs from
-# subdirs to album dir, delete everything else
-for d in dirs:
-    subdirs = [name for name in listdir(f'{s.base_dir}/{d}')
-               if path.isdir(path.join(f'{s.base_dir}/{d}', name))]
-
-    cd_num = 0
-    for sub in subdirs:
-        sub_path        = f'{s.base_dir}/{d}/{sub}'
-        sub_parent_path = f'{s.base_dir}/{d}'
-        subdir_mp3s   = glob(f'{sub_path}/*.mp3')
-        subdir_imgs   = glob(f'{sub_path}/*.jpg') + glob(f'{sub_path}/*.png')
-        
-        if subdir_mp3s:
-            cd_num += 1
-            last_slash = sub_path.rfind('/')
-            cdp = f'{sub_path[:last_slash]} {sub_path[last_slash+1:]}.CD{cd_num}'
-            renames(sub_path, cdp)
-            dir_content = glob(f'{sub_parent_path}/*')
-            if not dir_content:
-                rmdir(sub_parent_path)
-
-        elif subdir_imgs:
-            for i in subdir_imgs:
-                filename = i.split('/')[-1]
-                renames(i, f'{sub_parent_path}/{filename}')
-
-        elif not subdir_mp3s and not subdir_imgs:
-            rmdir(sub_path)
-
-dirs = [name for name in listdir(s.base_dir)
-        if path.isdir(path.join(s.base_dir, name))
-        and name != s.broken_dir
-        and name != s.notmp3_dir]
-
-
-# Tags to yaml file, directory level operations
-for file in files:
-    report_current(file)
-    tag_to_file(f'{s.base_dir}/{file}')
-
-
-for d in dirs:
-    dir_path  = f'{s.base_dir}/{d}'
-    dir_files = listdir(f'{dir_path}')
-
-    mp3_files = [f for f in dir_files if f.split('.')[-1] == 'mp3']
-    if not mp3_files:
-        print(f'folder "{d}" does not contain any mp3 files, skipping')
-        continue
-
-    artist_tags      = []
-    album_time       = 0
-    artist_has_comma = False
-
-
-    # First full iteration: calculate album length, gather artist names
-    for file in mp3_files:
-        full_path = f'{dir_path}/{file}'
+    return digest.hexdigest()
 
-        with NoStdErr():
-            parsed = eyed3.load(full_path)
 
-        if s.ep_eval:
-            album_time += parsed.info.time_secs
-            artist_tags.append(str(parsed.tag.artist))
-    
-    artist_tags.sort(key=len)
+def frame_info(header):
+    '''
+    Decodes 32-bit MPEG audio frame header. Returns (frame size, samples,
+    sample rate, kbps), or None if it isn't a valid header.
+    '''
+    version = header >> 19 & 3
+    layer   = header >> 17 & 3
+    br_idx  = header >> 12 & 15
+    sr_idx  = header >> 10 & 3
+    if header >> 21 != 0x7ff or version == 1 or not layer or \
+       br_idx in (0, 15) or sr_idx == 3:
+        return None
+
+    mpeg1       = version == 3
+    kbps        = MPEG_BITRATES[mpeg1, layer][br_idx]
+    sample_rate = MPEG_SAMPLE_RATES[version][sr_idx]
+    samples     = MPEG_SAMPLES[mpeg1, layer]
+    padding     = header >> 9 & 1
+    if layer == 3:
+        size = (12000 * kbps // sample_rate + padding) * 4
+    else:
+        size = samples // 8 * 1000 * kbps // sample_rate + padding
+    return size, samples, sample_rate, kbps
 
-    if ', ' in artist_tags[0]:
-        artist_has_comma = True
 
+def first_frame(mapped, start, end):
+    '''
+    Returns offset and header of the first audio frame between start and
+    end, i.e. of the first valid header followed by another frame of the
+    same stream (or by the end), or (None, None) if there is none.
+    '''
+    pos = mapped.find(b'\xff', start, end - 3)
+    while pos != -1:
+        header = int.from_bytes(mapped[pos:pos + 4], 'big')
+        info   = frame_info(header)
+        if info:
+            next_pos = pos + info[0]
+            if next_pos == end:
+                return pos, header
+            if next_pos + 4 <= end:
+                next_header = int.from_bytes(mapped[next_pos:next_pos + 4],
+                                             'big')
+                if frame_info(next_header) and \
+                   next_header & MPEG_STREAM_MASK == \
+                   header & MPEG_STREAM_MASK:
+                    return pos, header
+        pos = mapped.find(b'\xff', pos + 1, end - 3)
+    return None, None
+
+
+def vbr_header(mapped, pos, header):
+    '''
+    Reads Xing/Info or VBRI header of the frame at pos. Returns (frames,
+    bytes, VBR or not, offset of Xing frame count), counts and offset
+    being None when the header leaves them out, or None if the frame has
+    no such header.
+    '''
+    mpeg1 = header >> 19 & 3 == 3
+    mono  = header >> 6 & 3 == 3
+    if header >> 17 & 3 == 1:  # Xing only follows layer III side info
+        side = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+        xing = pos + 4 + side + (0 if header >> 16 & 1 else 2)
+        if mapped[xing:xing + 4] in (b'Xing', b'Info'):
+            flags    = int.from_bytes(mapped[xing + 4:xing + 8], 'big')
+            offset   = xing + 8
+            frames   = n_bytes = frames_at = None
+            if flags & 1:
+                frames    = int.from_bytes(mapped[offset:offset + 4], 'big')
+                frames_at = offset
+                offset   += 4
+            if flags & 2:
+                n_bytes = int.from_bytes(mapped[offset:offset + 4], 'big')
+            return (frames, n_bytes, mapped[xing:xing + 4] == b'Xing',
+                    frames_at)
+
+    if mapped[pos + 36:pos + 40] == b'VBRI':
+        n_bytes, frames = struct.unpack_from('>II', mapped, pos + 46)
+        return frames, n_bytes, True, None
+    return None
+
+
+def scan_frames(mapped, pos, end, header):
+    '''
+    Follows the chain of frames starting at pos, one at a time. Returns
+    number of frames, their bytes, lowest and highest kbps.
+    '''
+    stream  = header & MPEG_STREAM_MASK
+    frames  = n_bytes = high = 0
+    low     = None
+    while pos + 4 <= end:
+        header = int.from_bytes(mapped[pos:pos + 4], 'big')
+        info   = frame_info(header)
+        if not info or header & MPEG_STREAM_MASK != stream or \
+           pos + info[0] > end:
+            break
+        frames  += 1
+        n_bytes += info[0]
+        low      = info[3] if low is None else min(low, info[3])
+        high     = max(high, info[3])
+        pos     += info[0]
+    return frames, n_bytes, low, high
+
+
+def scan_frames_numpy(mapped, pos, end, header):
+    '''
+    Does the same as scan_frames, vectorized with numpy.
+
+    Every 0xff byte of the stream is a frame candidate. Candidates whose
+    header matches the stream get their frame size, which points at the
+    candidate the next frame should start at, if there is one. Following
+    the pointers one by one would take a Python step per frame, so they
+    are doubled instead: after k rounds each candidate knows where its
+    chain is 2^k frames later and the frame count, bytes and bitrates
+    on the way, so the whole chain is summed up in log2(n) array ops.
+    '''
+    import numpy as np
+
+    stream = header & MPEG_STREAM_MASK
+    mpeg1  = header >> 19 & 3 == 3
+    layer  = header >> 17 & 3
+    data   = np.frombuffer(mapped, dtype=np.uint8, count=end)
+
+    cand = np.flatnonzero(data[pos:end - 3] == 0xff) + pos
+    hdrs = (data[cand].astype(np.uint32) << 24 |
+            data[cand + 1].astype(np.uint32) << 16 |
+            data[cand + 2].astype(np.uint32) << 8 | data[cand + 3])
+    br_idx = hdrs >> 12 & 15
+    valid  = ((hdrs & MPEG_STREAM_MASK) == stream) & (br_idx != 0) & \
+             (br_idx != 15)
+    cand, hdrs, br_idx = cand[valid], hdrs[valid], br_idx[valid]
+
+    sample_rate = MPEG_SAMPLE_RATES[header >> 19 & 3][header >> 10 & 3]
+    kbps        = np.array(MPEG_BITRATES[mpeg1, layer],
+                           dtype=np.int64)[br_idx]
+    padding     = (hdrs >> 9 & 1).astype(np.int64)
+    if layer == 3:
+        size = (12000 * kbps // sample_rate + padding) * 4
+    else:
+        size = (MPEG_SAMPLES[mpeg1, layer] // 8 * 1000 * kbps //
+                sample_rate + padding)
+    fits = cand + size <= end
+    cand, kbps, size = cand[fits], kbps[fits], size[fits]
+
+    n    = len(cand)
+    if not n or cand[0] != pos:
+        return 0, 0, None, 0
+    nxt  = np.searchsorted(cand, cand + size)
+    nxt  = np.where(cand[np.minimum(nxt, n - 1)] == cand + size, nxt, n)
+
+    # Index n is the end of every chain, which stays where it is
+    jump    = np.append(nxt, n)
+    frames  = np.append(np.ones(n, dtype=np.int64), 0)
+    n_bytes = np.append(size, 0)
+    low     = np.append(kbps, kbps.max() + 1)
+    high    = np.append(kbps, 0)
+    for _ in range(n.bit_length()):
+        frames  += frames[jump]
+        n_bytes += n_bytes[jump]
+        low      = np.minimum(low, low[jump])
+        high     = np.maximum(high, high[jump])
+        jump     = jump[jump]
+    return int(frames[0]), int(n_bytes[0]), int(low[0]), int(high[0])
+
+
+def follow_frames(mapped, pos, end, header):
+    '''
+    Returns number of frames, their bytes, lowest and highest kbps of
+    the stream starting at pos, from scan_frames_numpy for streams of
+    over 2000 frames (if numpy is installed), from scan_frames otherwise.
+    '''
+    if (end - pos) // frame_info(header)[0] > 2000:
+        try:
+            return scan_frames_numpy(mapped, pos, end, header)
+        except ImportError:
+            pass
+    return scan_frames(mapped, pos, end, header)
 
-    # Second interation: correct tags
-    for file in mp3_files:
-        report_current(file)
-        full_path = f'{dir_path}/{file}'
-        tag_to_file(full_path, 'album', album_artist=artist_tags[0])
 
+def audio_stats(filepath):
+    '''
+    Returns length and bitrate of an mp3 file, as {'time_secs', 'kbps',
+    'min_kbps', 'max_kbps', 'vbr'}.
+
+    Length comes from Xing/Info or VBRI header of the first frame if it
+    has one, which only takes reading a few bytes; lowest and highest
+    bitrates are unknown (None) then. Otherwise the memory-mapped file
+    is scanned frame by frame, with numpy if it's installed and the file
+    is longer than a minute or so. A file with no frames at all is 0
+    seconds long.
+    '''
+    with open(filepath, 'rb') as f:
+        start, end = audio_span(f)
+        if end - start < 4:
+            return stream_stats(None, None, None)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            pos, header = first_frame(mapped, start, end)
+            if pos is None:
+                return stream_stats(None, None, None)
+
+            vbr  = vbr_header(mapped, pos, header)
+            scan = None
+            if not (vbr and vbr[0]):
+                scan = follow_frames(mapped, pos, end, header)
+    return stream_stats(header, vbr, scan)
+
+
+def stream_stats(header, vbr, scan):
+    '''
+    Returns audio_stats of a stream from header of its first frame, what
+    vbr_header found in that frame and what follow_frames found in the
+    stream, the last only needed when there's no frame count in a VBR
+    header. No header means no stream.
+    '''
+    stats = {'time_secs': 0, 'kbps': 0, 'min_kbps': None, 'max_kbps': None,
+             'vbr': False}
+    if header is None:
+        return stats
+    size, samples, sample_rate, _ = frame_info(header)
+
+    if vbr and vbr[0]:
+        frames, n_bytes, stats['vbr'] = vbr[:3]
+        n_bytes = n_bytes or frames * size
+        low     = high = None
+    else:
+        frames, n_bytes, low, high = scan
+        stats['vbr'] = low != high
 
-    # Sort out folder images
-    for f in dir_files:
-        if '.jpeg' in f:
-            src_path     = f'{dir_path}/{f}'
-            new_filename = re.sub('\.jpeg', '.jpg', f)
-            dest_path    = f'{dir_path}/{new_filename}'
-            renames(src_path, dest_path)
+    stats['time_secs'] = frames * samples / sample_rate
+    if stats['time_secs']:
+        stats['kbps'] = round(n_bytes * 8 / stats['time_secs'] / 1000)
+    stats['min_kbps'], stats['max_kbps'] = low, high
+    return stats
 
-    dir_imgs     = [name for name in listdir(f'{dir_path}')
-                    if '.jpg' in name or '.png' in name]
-    img_iter     = 0
-    front_exists = False
-    back_exists  = False
 
-    for f in dir_imgs:
-        report_current(f)
-        f_path = f'{dir_path}/{f}'
+def check_stream(filepath, fix=True):
+    '''
+    Checks audio stream of an mp3 file, fixes common problems in place.
+
+    The memory-mapped file is gone through once: frame sync and headers
+    of all frames (every one has to belong to the same stream as the
+    first), the last frame, what is left after it, tag placement. What
+    gets fixed is garbage after the last frame, truncated last frame
+    (both are cut off, ID3v1 tag stays at the end) and wrong frame count
+    in Xing/Info header. Returns status and audio_stats of the file as
+    it is left, read on the way, so that the file isn't scanned again
+    for them. Status is 'ok', 'fixed' ('fixable' when fix is False),
+    'broken' for a file with no audio frames at all, or 'unknown' for
+    problems it leaves to mp3val: junk before the first frame, garbage
+    or another stream in the middle, tags or unknown data after the
+    last frame. Stats are None for the last two.
+    '''
+    with open(filepath, 'rb') as f:
+        start, end = audio_span(f)
+        if end - start < 4:
+            return 'broken', None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            pos, header = first_frame(mapped, start, end)
+            if pos is None:
+                return 'broken', None
+            if pos != start:
+                return 'unknown', None
+
+            scan       = follow_frames(mapped, pos, end, header)
+            frames     = scan[0]
+            stream_end = pos + scan[1]
+            if stream_end < end:
+                rest = mapped[stream_end:end]
+                if first_frame(mapped, stream_end, end)[0] is not None or \
+                   any(marker in rest for marker in (b'ID3', b'APETAGEX',
+                                                     b'LYRICSBEGIN')):
+                    return 'unknown', None
+
+            vbr       = vbr_header(mapped, pos, header)
+            frames_at = None
+            if vbr and vbr[3] is not None and vbr[0] != frames - 1:
+                frames_at = vbr[3]  # Xing frame doesn't count itself
+
+    if stream_end == end and frames_at is None:
+        return 'ok', stream_stats(header, vbr, scan)
+    if not fix:
+        return 'fixable', stream_stats(header, vbr, scan)
+
+    with open(filepath, 'r+b') as f:
+        if frames_at is not None:
+            f.seek(frames_at)
+            f.write((frames - 1).to_bytes(4, 'big'))
+            vbr = (frames - 1, *vbr[1:])
+        if stream_end < end:
+            f.seek(end)
+            tag_v1 = f.read()
+            f.seek(stream_end)
+            f.write(tag_v1)
+            f.truncate()
+    return 'fixed', stream_stats(header, vbr, scan)
+
+
+def fold_tag(val):
+    '''Folds a tag value for comparison: lowercase, single spaces.'''
+    return ' '.join(str(val or '').lower().split())
+
+
+def cluster_tracks(tracks, min_tracks, feat_rgx):
+    '''
+    Groups loose tracks into albums by their tags, in one pass.
+
+    Tracks are (path, tags) pairs, tags as read_tags returns them. Each
+    track goes to a hash index under its folded (album artist, album,
+    year, disc) key, with album artist falling back to track artist
+    stripped of featured artists. Discs of one album are then joined
+    and albums with at least min_tracks tracks are kept, so layout of
+    files doesn't matter and nothing is compared pairwise. Returns
+    paths of the remaining singles, in original order, and a list of
+    albums as {disc number: [paths]}, with None for the only disc of
+    single-disc albums. With min_tracks of 0 nothing gets clustered.
+    '''
+    if not min_tracks:
+        return [track_path for track_path, tags in tracks], []
 
-        file_size = path.getsize(f_path)
-        if file_size < s.img_min_size:
-            print(f' {f} file size is too small, deleting...')
-            remove(f_path)
+    index = {}
+    for track_path, tags in tracks:
+        album = fold_tag(tags['album'])
+        if not album:
+            continue
+        artist = fold_tag(tags['album_artist'] or
+                          feat_rgx.split(fold_tag(tags['artist']))[0])
+        key    = (artist, album, str(tags['date'] or '')[:4],
+                  tags['disc'] or 1)
+        index.setdefault(key, []).append(track_path)
+
+    discs = {}
+    for key, paths in index.items():
+        discs.setdefault(key[:3], {})[key[3]] = paths
+
+    albums    = []
+    clustered = set()
+    for album_discs in discs.values():
+        if sum(len(paths) for paths in album_discs.values()) < min_tracks:
             continue
+        if len(album_discs) == 1:
+            album_discs = {None: next(iter(album_discs.values()))}
+        albums.append(dict(sorted(album_discs.items(),
+                                  key=lambda disc: disc[0] or 0)))
+        clustered.update(track_path for paths in album_discs.values()
+                         for track_path in paths)
 
-        if s.img_conv_compr:
-            if '.jpg' in f:
-                c_rate = run(['identify', '-format', '%Q', f_path],
-                             stdout=PIPE).stdout
-                c_rate = int(c_rate)
-                if c_rate == 100:
-                    run(['jpegoptim', f'-m{s.jpg_compr_lvl}', f_path],
-                    stdout=DEVNULL)
-
-            if '.png' in f:
-                run(['mogrify', '-format', 'jpg', '-quality', '100', f_path],
-                    stdout=DEVNULL)
-                remove(f_path)
-                f = re.sub('\.png', '.jpg', f)
-                f_path = f'{dir_path}/{f}'
+    singles = [track_path for track_path, tags in tracks
+               if track_path not in clustered]
+    return singles, albums
 
-                run(['jpegoptim',
-                     f'-m{s.jpg_compr_lvl}',
-                     f_path],
-                    stdout=DEVNULL)
 
-        if len(dir_imgs) == 1 and f != 'front.jpg':
-            rename_img(dir_path, f, 'front')
-            front_exists = True
+def copy_range(src, dest, offset=0):
+    '''
+    Copies open file src, from offset to its end, to where open file
+    dest is at.
 
-        else:
-            if not front_exists and ('front' in f or 'folder' in f):
-                rename_img(dir_path, f, 'front')
-                front_exists = True
+    Data never leaves the kernel: it goes with copy_file_range, which
+    also shares blocks on filesystems that can, or with sendfile where
+    that doesn't work (across filesystems on older kernels, Python
+    older than 3.8). Plain reads and writes are the last resort.
+    '''
+    dest.flush()
+    src_fd, dest_fd = src.fileno(), dest.fileno()
+    end             = stat(src_fd).st_size
 
-            elif not back_exists and 'back' in f:
-                rename_img(dir_path, f, 'back')
-                back_exists = True
+    try:
+        from os import copy_file_range
+    except ImportError:
+        copy_file_range = None
 
-            else:
-                img_iter      +=1
-                img_iter_final = (f'0{img_iter}' if len(str(img_iter)) == 1
-                                  else img_iter)
-                rename_img(dir_path, f, f"album-art-{img_iter_final}")
-
-    dir_jpgs = [f'{dir_path}/{name}' for name in listdir(f'{dir_path}')
-                if '.jpg' in name]
-    for j in dir_jpgs:
-        stripe = f'-\n  path: "{j}"\n'
-        with open(s.tag_changes_file, 'a') as f:
-            f.write(stripe)
-
-
-
-# Correct tags file:
-# * reads file containing freshly-fetched tag information
-# * extracts just the tag data from yaml
-# * runs a series of string corrections on it
-# * glues it to the remainder of that yaml file
-# * saves to a file and prompts user to edit it
-curr_file = 0
-with open(s.tag_changes_file) as f:
-    tags_file = f.read().splitlines()
-
-keys = []
-vals = []
-for t in tags_file:
-    if s.base_dir in t or t == '-':
-        keys.append(t)
-        vals.append('')
-    else:
-        keys.append(t.split(': ')[0])
-        vals.append(t.split(': ', 1)[1])
+    for method in ('copy_file_range', 'sendfile'):
+        try:
+            while offset < end:
+                if method == 'sendfile':
+                    copied = sendfile(dest_fd, src_fd, offset, end - offset)
+                elif copy_file_range:
+                    copied = copy_file_range(src_fd, dest_fd, end - offset,
+                                             offset)
+                else:
+                    break
+                if not copied:  # file got shorter
+                    end = offset
+                offset += copied
+        except OSError as err:
+            if err.errno not in (EINVAL, ENOSYS, EOPNOTSUPP, EXDEV):
+                raise
+
+    if offset < end:
+        src.seek(offset)
+        copyfileobj(src, dest, 1 << 20)
+    dest.seek(0, 2)
+
+
+def place_file(src_path, dest_path, mode='copy', fallback=True):
+    '''
+    Puts a copy of a file at dest_path, leaving the original alone.
+
+    Mode is 'hardlink' (same inode, no data written), 'reflink' (new
+    inode sharing data blocks, with FICLONE ioctl, on btrfs, XFS and
+    the like) or 'copy'. What can't be done, across filesystems or on
+    filesystems without reflinks, falls back to the next mode in that
+    order. Copies go to a temporary file first, so an existing file at
+    dest_path is only replaced with a complete one. Returns the mode
+    that got used. Without fallback, nothing is placed when the mode
+    can't be done, and None is returned.
+    '''
+    from fcntl import ioctl
 
-tag_string = '\n'.join(vals)
+    makedirs(path.dirname(dest_path), exist_ok=True)
 
-if s.enable_nlp:
-    tag_string = nlp_capitalize(tag_string)
-else:
-    tag_string = tag_string.title()
+    if mode == 'hardlink':
+        try:
+            if path.lexists(dest_path):
+                if path.samefile(src_path, dest_path):
+                    return 'hardlink'
+                remove(dest_path)
+            link(src_path, dest_path)
+            return 'hardlink'
+        except OSError as err:
+            if err.errno not in (EMLINK, EPERM, EXDEV):
+                raise
+            if not fallback:
+                return None
+        mode = 'reflink'
+
+    with open(src_path, 'rb') as src, \
+         NamedTemporaryFile('wb', dir=path.dirname(dest_path),
+                            delete=False) as tmp_file:
+        if mode == 'reflink':
+            try:
+                ioctl(tmp_file.fileno(), FICLONE, src.fileno())
+            except OSError as err:
+                if err.errno not in (EINVAL, ENOTTY, EOPNOTSUPP, EXDEV):
+                    raise
+                mode = 'copy' if fallback else None
+        if mode == 'copy':
+            copy_range(src, tmp_file)
+    if mode is None:
+        remove(tmp_file.name)
+        return None
+    copymode(src_path, tmp_file.name)
+    replace(tmp_file.name, dest_path)
+    return mode
+
+
+class TrackRecord:
+    '''
+    Tag changes record of a single or album track.
 
+    Single tracks have no album artist. Only tracks of multi-disc albums
+    have a disc number, which is neither corrected nor required. Fields
+    are kept as plain strings, exactly as they are going to be saved.
+    '''
+    __slots__ = ('album_artist', 'artist', 'album', 'title', 'date',
+                 'track_num', 'disc', 'path')
 
-regexes = {
-    'AiN\'t':                                      'Ain\'t',
-    r'(?<=\d)Am(?=\b)':                            'AM',    
-    'dN\'t':                                       'dn\'t',
-    'DoN\'t':                                      'Don\'t',
-    r'\bEp\b(?=[^\.])':                            'EP',
-    r'\bMc\b':                                     'MC',
-    r'(?<=\d)Pm(?=\b)':                            'PM',
-}
+    KEYS = {'album artist': 'album_artist', 'artist': 'artist',
+            'album': 'album', 'title': 'title', 'date': 'date',
+            'track no': 'track_num', 'disc': 'disc', 'path': 'path'}
 
+    def __init__(self, artist, album, title, date, track_num, path,
+                 album_artist=None, disc=''):
+        self.album_artist = album_artist
+        self.artist       = artist
+        self.album        = album
+        self.title        = title
+        self.date         = date
+        self.track_num    = track_num
+        self.disc         = disc
+        self.path         = path
 
-if s.del_bonus_track:
-    regexes[' ?[\[\(] ?[Bb]onus [Tt]rack ?[\]\)]']      = ''
+    @property
+    def is_album(self):
+        return self.album_artist is not None
 
-if s.del_explicit:
-    regexes[' ?[\[\(] ?[Ee]xplicit ?[\]\)]']            = ''
+    def fields(self):
+        '''Returns (key, value) pairs, in tag changes file order.'''
+        return [(key, getattr(self, attr)) for key, attr in self.KEYS.items()
+                if (attr != 'album_artist' or self.is_album) and
+                   (attr != 'disc' or self.disc)]
 
-if s.del_lp:
-    regexes[r' ?[\(\[]?\b[Ll][Pp]\b ?[\)\]]?']          = ''
+    def tag_fields(self):
+        '''Returns (key, value) pairs of fields that get corrected.'''
+        return [(key, val) for key, val in self.fields()
+                if key != 'path' and key != 'disc']
 
-if s.del_orig_mix:
-    regexes[' ?[\[\(] ?[Oo]riginal [Mm]ix ?[\]\)]']     = ''
 
-if s.del_produced:
-    regexes[' ?[\(\[] ?[Pp]rod(?:\.|uced)(?: [Bb]y|)'
-    '[^\)\]\n]+ ?[\)\]]']                               = ''
+class ImageRecord:
+    '''Tag changes record of an album image, which only gets moved.'''
+    __slots__ = ('path',)
 
+    KEYS = {'path': 'path'}
 
-if s.chn_edit:
-    regexes[' ?[\(\[] ?[Ee]dit ?[\)\]]']                = s.chn_edit
+    def __init__(self, path):
+        self.path = path
 
-if s.chn_extended:
-    regexes[' ?[\[\(] ?[Ee]xtended ?[\]\)]']            = s.chn_extended
+    def fields(self):
+        return [('path', self.path)]
 
-if s.chn_extended_mix:
-    regexes[' ?[\[\(]? ?[Ee]xtended [Mm]ix ?[\]\)]?']   = s.chn_extended_mix
+    def tag_fields(self):
+        return []
 
-if s.chn_instrumental:
-    regexes[' ?[\[\(] ?[Ii]nstr(?:\.|umental) ?[\]\)]'] = s.chn_instrumental
 
-if s.chn_live:
-    regexes[' ?[\(\[] ?[Ll]ive ?[\)\]]']                = s.chn_live
+def write_records(filepath, records):
+    '''
+    Writes tag changes records to a file, as one buffered stream.
 
-if s.chn_mix:
-    regexes[' ?[\[\(] ?(.+) [Mm]ix ?[\]\)]']            = s.chn_mix
+    Values are written as JSON strings, which are valid YAML double-quoted
+    scalars too, so the file stays readable by any YAML parser and
+    quotes, backslashes or colons in values need no special care.
+    '''
+    with open(filepath, 'w', buffering=1 << 16) as f:
+        for n, record in enumerate(records):
+            if n:
+                f.write('\n')
+            f.write('-')
+            for key, val in record.fields():
+                f.write(f'\n  {key}: {json.dumps(val, ensure_ascii=False)}')
+
+
+def parse_field(line):
+    '''Parses one "key: value" line of tag changes file.'''
+    key, _, val = line.partition(':')
+    key, val    = key.strip(), val.strip()
+    if key not in TrackRecord.KEYS:
+        raise ValueError(f'unknown field "{key}"')
+
+    if val[:1] == '"':
+        try:
+            val = json.loads(val)
+        except ValueError:
+            raise ValueError('malformed value') from None
+    elif val[:1] == "'":
+        val = val[1:-1].replace("''", "'")
+    return key, val
 
-if s.chn_ost:
-    regexes[' Ost']                                     = s.chn_ost
 
-if s.chn_orig_sdtrack:
-    regexes[' ?[\[\(]? ?(?:[Oo]riginal )(?:[Mm]ovie |)'
-    '(?:[Mm]otion |)(?:[Pp]icture |)[Ss]oundtrack'
-    ' ?(?:[Aa]lbum|)[\]\)]?']                           = s.chn_orig_sdtrack
+def parse_record(fields, filepath, line_no):
+    '''Turns {key: value} read from tag changes file into a record.'''
+    if set(fields) == {'path'}:
+        return ImageRecord(fields['path'])
 
-if s.chn_cover:
-    regexes['[\[\(] ?(\w+) Cover ?[\]\)]']              = s.chn_cover
+    missing = set(TrackRecord.KEYS) - set(fields) - {'album artist', 'disc'}
+    if missing:
+        sys.exit(f'Error: record ending at line {line_no} of '
+                 f'{filepath} is missing {", ".join(sorted(missing))}. '
+                 'Exiting...')
 
-if s.chn_remix:
-    regexes['[Rr]emix']                                 = s.chn_remix
+    return TrackRecord(**{TrackRecord.KEYS[key]: val
+                          for key, val in fields.items()})
 
-if s.chn_remix2:
-    regexes[' ?[\[\(] ?[Rr]emix ?[\]\)]']               = s.chn_remix2
 
-if s.chn_remix3:
-    regexes[' ?[\[\(] ?(.+) [Rr]emix ?[\]\)]']          = s.chn_remix3
+def read_records(filepath):
+    '''
+    Yields tag changes records read from a file, one at a time.
 
-if s.chn_reprise:
-    regexes['[Rr]eprise']                               = s.chn_reprise
+    Accepts what a YAML list of flat mappings with string values may
+    look like after editing: fields in any order, blank lines, comments,
+    double-quoted, single-quoted or plain values, and the first field
+    on the same line as the dash.
+    '''
+    fields  = None
+    line_no = 0
+
+    with open(filepath) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+
+            if line == '-' or line.startswith('- '):
+                if fields:
+                    yield parse_record(fields, filepath, line_no - 1)
+                fields = {}
+                line   = line[2:].strip()
+                if not line:
+                    continue
+            if fields is None:
+                continue
+
+            try:
+                key, val = parse_field(line)
+            except ValueError as err:
+                sys.exit(f'Error: {err} at line {line_no} of {filepath}. '
+                         'Exiting...')
+            fields[key] = val
+
+    if fields:
+        yield parse_record(fields, filepath, line_no)
+
+
+def running_apps(names):
+    '''
+    Returns those of given program names which are running.
 
-if s.chn_version:
-    regexes[' ?[\(\[] ?(.+) [Vv]ersion ?[\)\]]']        = s.chn_version
+    Like 'ps aux | grep -i name', looks for names in command lines of
+    all processes, ignoring case, but reads them straight from /proc,
+    in one pass for all names. Where there is no /proc, asks ps once.
+    '''
+    lowered = [name.lower() for name in names]
+    own_pid = str(getpid())
+    found   = set()
 
-regexes[' {2,}']                                        = ' '
+    try:
+        proc_entries = list(scandir('/proc'))
+    except OSError:
+        ps_output = run(['ps', 'axww', '-o', 'args='], stdout=PIPE,
+                        stderr=DEVNULL).stdout
+        cmdlines  = ps_output.decode(errors='replace').lower().split('\n')
+    else:
+        cmdlines = []
+        for entry in proc_entries:
+            if not entry.name.isdigit() or entry.name == own_pid:
+                continue
+            try:
+                with open(f'{entry.path}/cmdline', 'rb') as f:
+                    cmdline = f.read()
+                if not cmdline:  # kernel threads
+                    with open(f'{entry.path}/comm', 'rb') as f:
+                        cmdline = f.read()
+            except OSError:  # process is already gone
+                continue
+            cmdlines.append(cmdline.replace(b'\0', b' ')
+                                   .decode(errors='replace').lower())
+
+    for cmdline in cmdlines:
+        found.update(name for name in lowered if name in cmdline)
+    return [name for name in names if name.lower() in found]
 
 
+def romantoarabic(title):
+    '''Converts low Roman numeral strings to Arabic numeral stirngs.'''
+    for roman, roman_rgx, arabic in ROMAN_RULES:
+        if roman in title:
+            title = roman_rgx.sub(arabic, title)
 
-for key, val in regexes.items():
-    tag_string = re.sub(key, val, tag_string)
+    title = ROMAN_V_RGX.sub(' 5', title)
+    return title
 
-tag_string = re.sub('("\w)', lambda m: m.group(1).upper(), tag_string)
 
-vals = tag_string.split('\n')
+def spawn(args, stdout=DEVNULL):
+    '''
+    Runs a program like subprocess.run does, returns its output (if
+    stdout is PIPE) and CPU seconds it took. The program is waited for
+    with wait4, which tells its own CPU time, even while other threads
+    run programs too.
+    '''
+    from subprocess import Popen
 
-tags_file = ''
-for key,val in zip(keys,vals):
-    if val:
-        tags_file += f'{key}: {val}\n'
-    else:
-        tags_file += f'{key}\n'
+    proc   = Popen(args, stdout=stdout)
+    output = proc.stdout.read() if stdout == PIPE else None
+    if proc.stdout:
+        proc.stdout.close()
+    pid, status, usage = wait4(proc.pid, 0)
+    proc.returncode    = status  # already reaped, Popen mustn't wait
+    return output, usage.ru_utime + usage.ru_stime
 
-with open(s.tag_changes_file, 'w') as f:
-    f.write(tags_file.strip())
 
+def cover_art(img_path, max_size, quality):
+    '''
+    Returns JPEG data of an image, to be embedded in tags: contents of
+    the file itself if it is a jpg no bigger than max_size pixels either
+    way, otherwise the image scaled down to fit and encoded anew.
+    '''
+    from io import BytesIO
+    from PIL import Image
 
-if s.text_editor:
-    run([s.text_editor, s.tag_changes_file])
-    input('\nFinished correcting the file? Press ENTER...')
+    with Image.open(img_path) as img:
+        if img.format == 'JPEG' and max(img.size) <= max_size:
+            with open(img_path, 'rb') as f:
+                return f.read()
+        img = img.convert('RGB')
+        img.thumbnail((max_size, max_size), Image.LANCZOS)
+        data = BytesIO()
+        img.save(data, 'JPEG', quality=quality, optimize=True)
+        return data.getvalue()
 
 
+def planned_img(img_path):
+    '''Returns path compress_img would return, without touching image.'''
+    return re.sub('\.png$', '.jpg', img_path)
 
-# Save tags, move files:
-# * read and parse the yaml tag data file
-# * parse mp3 files and save tags to them
-# * set up directory and filenames based on tag data
-# * rename files, move them to newly-created directories
-print('\nSaving tags, moving files...')
-total_n_of_files = eval_total_files()
-yaml_rgx = '(?<=").+(?=")'
 
-with open(s.tag_changes_file) as f:
-    tag_stripes = f.read().strip('-\s\n').split('\n-\n')
+def jpg_quality(img):
+    '''
+    Estimates jpg quality (1-100) from its luminance quantization table.
 
-for t in tag_stripes:
-    tag_stripe = t.split('\n')
-    src_path   = re.search(yaml_rgx, tag_stripe[-1])[0]
-    filename   = src_path.split('/')[-1]
+    Uses the same scaling formula libjpeg uses to build tables from
+    quality setting, just in reverse.
+    '''
+    table = img.quantization.get(0) if hasattr(img, 'quantization') else None
+    if not table:
+        return None
+    if max(table) == 1:
+        return 100
 
-    if len(tag_stripe) == 1:  # image
-        report_current(filename)
-        renames(src_path, f'{final_dir}/{filename}')
-        continue
+    scale = sum(table) * 100 / sum(JPG_LUMA_TABLE)
+    if scale <= 100:
+        return round((200 - scale) / 2)
+    return round(5000 / scale)
 
-    with NoStdErr():
-        parsed = eyed3.load(src_path)
-    parsed.tag.clear()
 
-    try:
-        if len(tag_stripe) == 7:  # album
-            parsed.tag.album_artist = re.search(yaml_rgx, tag_stripe[0])[0]
-        parsed.tag.artist         = re.search(yaml_rgx, tag_stripe[-6])[0]
-        parsed.tag.album          = re.search(yaml_rgx, tag_stripe[-5])[0]
-        parsed.tag.title          = re.search(yaml_rgx, tag_stripe[-4])[0]
-        parsed.tag.recording_date = re.search(yaml_rgx, tag_stripe[-3])[0]
-        parsed.tag.track_num      = re.search(yaml_rgx, tag_stripe[-2])[0]
-    except TypeError:
-        print('Error: at least one tag field in file was left blank. '
-              'Exiting...')
-        sys.exit()
+class Cleaner:
+    '''
+    Cleans mp3 files found in base_dir and moves them to dest_dir.
+
+    Settings can be the settings module or any object with the same
+    attributes. All state of a run is kept here, and so are parsed
+    files, title and image caches, manifest and the spacy model, so one
+    process can clean one batch after another without loading anything
+    twice.
+    Every stage is a method of its own, clean runs them all in order.
+
+    With plan set to a report file ('-' for stdout), nothing is
+    touched, the run only reports what it would do. With output_mode
+    other than 'move', base_dir isn't touched either: files are sorted
+    out in the index only, and go to dest_dir as copies, which get the
+    tags and the repairs. An unattended
+    cleaner never opens tag changes file in text editor and doesn't
+    care about blacklisted apps: whoever runs it makes sure that
+    nothing else works on its files.
+    '''
+    def __init__(self, settings=None, jobs=None, full=False, plan=None,
+                 unattended=False):
+        if settings is None:
+            import settings
+
+        self.s             = settings
+        self.jobs          = settings.jobs if jobs is None else jobs
+        self.plan          = plan
+        self.virtual       = bool(plan) or settings.output_mode != 'move'
+        self.plan_out      = sys.stdout
+        self.unattended    = unattended
+        self.regexes       = tag_regexes(settings)
+        self.rules         = None
+        self.title_cache   = None
+        self.img_cache     = None
+        self.spawned       = local()  # CPU time of programs by thread
+        self.covers        = {}  # front cover path: data to embed
+        self.covers_lock   = Lock()
+        self.feat_rgx      = re.compile(settings.feat_rgx)
+        self.feat_tail_rgx = re.compile(f'{settings.feat_rgx}.+')
+        self.metrics       = Metrics()
+        self.mp3_cache     = {}
+        self.tags_read     = {}  # path: (size and mtime, read_tags data)
+        self.streams       = {}  # path: (size and mtime, audio_stats data)
+        self.nlp           = None
+        self.tree          = None
+        self.tree_lock     = Lock()
+        self.manifest      = Manifest(settings.manifest_file, trust=not full,
+                                      read_only=bool(plan))
+        self.journal       = Journal(settings.journal_file)
+        self.tags_saved    = (0, 0)
+        self.to_fix        = set()
+
+        self.curr_file        = 0
+        self.total_n_of_files = 0
+
+    def clean(self, names=None):
+        '''
+        Runs all stages on what is in base_dir, or only on its files and
+        directories with given names, returns planned moves.
+        '''
+        self.start()
+
+        if self.journal.exists() and not self.plan:
+            print('Previous run was interrupted while moving files. Start '
+                  'the program with "--resume" to finish it, or with '
+                  '"--rollback" to undo it. Exiting...')
+            sys.exit()
+
+        self.scan(names)
+        self.dedupe()
+        if self.has_mp3s():
+            self.validate()
+            self.flatten()
+            self.sort_images()
+            moves = self.review(self.correct(self.extract()))
+            self.apply(moves)
+        else:
+            print(f'No mp3 files found in {self.s.base_dir}, nothing to '
+                  'clean')
+            moves = []
+        self.clean_up()
+        self.metrics.switch(None)
+
+        if self.plan:
+            self.write_plan(self.plan, moves)
+        self.forget_run()
+        return moves
+
+    def resume(self):
+        '''
+        Finishes saving and moving files of an interrupted run. Returns
+        False if there is no such run.
+        '''
+        self.start()
+        if not self.journal.exists():
+            return False
+        moves, done, _ = self.journal.read()
+
+        print('Resuming interrupted run, saving tags, moving files...')
+        self.metrics.switch('save')
+        self.tree       = TreeIndex(self.s.base_dir, metrics=self.metrics)
+        self.journal.reopen()
+        self.tags_saved = self.run_moves(moves, done)
+        self.journal.remove()
+        self.metrics.switch(None)
+        return True
+
+    def rollback(self):
+        '''
+        Moves files of an interrupted run back where they were, with
+        their original tags. Returns False if there is no such run.
+        '''
+        self.start()
+        if not self.journal.exists():
+            return False
+        moves, done, originals = self.journal.read()
+
+        print('Rolling back interrupted run...')
+        self.rollback_moves(moves, originals)
+        self.journal.remove()
+        self.metrics.switch(None)
+        return True
+
+    def close(self):
+        '''Saves and closes title and image caches and manifest.'''
+        if self.title_cache:
+            self.title_cache.close()
+        if self.img_cache:
+            self.img_cache.close()
+        self.manifest.close()
+
+    # Startup actions:
+    # * checks if important fields are properly set in settings
+    # * verifies if any blacklisted program is running, prevents running
+    #   if so
+    def start(self):
+        '''Starts measuring a new run, checks if it can go on.'''
+        self.metrics    = Metrics()
+        self.tags_saved = (0, 0)
+        self.metrics.switch('startup')
+        print('MP3 Cleaner started, reading files...')
+
+        s = self.s
+        if not all([s.base_dir, s.dest_dir, s.tag_changes_file,
+                    s.feat_rgx]) or not any([s.write_to_v1, s.write_to_v2]):
+            print('Please fill all the "file settings" fields in settings.py '
+                  'before running this program')
+            sys.exit()
+
+        if s.app_blacklist and not self.unattended:
+            running = running_apps(s.app_blacklist)
+            if running:
+                raise ValueError(
+                  f'Please close {", ".join(running)} first before running '
+                  'the program. Exiting...')
+
+    def has_mp3s(self):
+        '''Tells if there are any mp3 files to work on in the index.'''
+        s = self.s
+
+        for (root, names) in self.tree.entries.items():
+            if not s.broken_dir in root and not s.notmp3_dir in root and \
+               not s.duplicates_dir in root and \
+               any(name.endswith('.mp3') for name, size in names.items()
+                   if size is not None):
+                return True
+        return False
+
+    def album_dirs(self):
+        '''Lists directories of base_dir, besides broken and notmp3.'''
+        return [name for name in self.tree.subdirs(self.s.base_dir,
+                                                   hidden=True)
+                if name not in (self.s.broken_dir, self.s.notmp3_dir,
+                                self.s.duplicates_dir)]
+
+    # Reads the tree, leaves out items already copied to dest_dir, moves
+    # non-mp3 albums to notmp3_dir, deletes junk files
+    def scan(self, names=None):
+        '''
+        Indexes base_dir (or just given items of it), moves out what the
+        program can't work on.
+        '''
+        s = self.s
+        self.metrics.switch('scan')
+
+        if not self.virtual:
+            makedirs(f'{s.base_dir}/{s.broken_dir}', exist_ok=True)
+        tree = self.tree = TreeIndex(s.base_dir, virtual=self.virtual,
+                                     metrics=self.metrics, names=names)
+
+        # Copies of files and albums cleaned before are in dest_dir already
+        if s.output_mode != 'move':
+            for item in self.album_dirs() + tree.files(s.base_dir):
+                item_path = f'{s.base_dir}/{item}'
+                mp3_files = [f for f in (tree.walk_files(item_path)
+                                         if tree.is_dir(item_path)
+                                         else [item_path])
+                             if f.endswith('.mp3')]
+                if mp3_files and all(self.manifest.is_exported(f)
+                                     for f in mp3_files):
+                    tree.discard(item_path)
+
+        notmp3_formats = ('.aac', '.aiff', '.alac', '.ape', '.flac', '.mpc',
+                          '.ogg', '.opus', '.wav', '.wma')
+
+        for d in self.album_dirs():
+            dir_path = f'{s.base_dir}/{d}'
+            notmp3_files = [f for f in tree.walk_files(dir_path)
+                            if path.splitext(f)[1] in notmp3_formats]
+            if notmp3_files:
+                print(f'"{d}" directory contains flac files, moving it to '
+                      f'"{s.notmp3_dir}" directory')
+                tree.rename(dir_path, f'{s.base_dir}/{s.notmp3_dir}/{d}')
+
+        all_files = tree.walk_files(s.base_dir)
+        jnk_files = [j for j in all_files if path.splitext(j)[1] not in
+                     ('.jpeg', '.jpg', '.mp3', '.png')]
+
+        for jnk_file in jnk_files:
+            tree.remove(jnk_file)
+
+    # Find duplicate tracks before anything expensive runs on them:
+    # * reads audio size of every mp3 file, from its tag headers only
+    # * hashes audio frames of files whose audio size matches another
+    #   file's, in base_dir or in dest_dir index
+    # * moves duplicates to duplicates_dir, deletes or just reports them,
+    #   albums with nothing but duplicates go away whole
+    def dedupe(self):
+        '''
+        Finds tracks whose audio is already in base_dir or dest_dir.
+
+        Tracks of album directories come before loose ones, so the copy
+        in an album is kept, otherwise the first one in order is. Tracks
+        already in dest_dir are all duplicates.
+        '''
+        s, tree = self.s, self.tree
+        if not s.duplicates:
+            return
+        self.metrics.switch('dedupe')
+
+        single_slashes = s.base_dir.count('/') + 1
+        mp3_files = sorted((f for f in tree.walk_files(s.base_dir)
+                            if f.endswith('.mp3')),
+                           key=lambda f: (f.count('/') == single_slashes,
+                                          path.split(f)))
+        sizes     = {f: audio_size(tree.real_path(f)) for f in mp3_files}
+        library   = (self.index_library(set(sizes.values()))
+                     if s.duplicates_in_dest else {})
+
+        size_counts = {}
+        for size in sizes.values():
+            size_counts[size] = size_counts.get(size, 0) + 1
+
+        originals  = {}  # audio hash: path of the copy that stays
+        duplicates = {}  # path of a duplicate: path of its original
+        for mp3_path in mp3_files:
+            size = sizes[mp3_path]
+            if size_counts[size] == 1 and size not in library:
+                continue
+            file_hash = self.manifest.content_hash(tree.real_path(mp3_path))
+            self.metrics.count('hashes')
+            original  = (library.get(size, {}).get(file_hash) or
+                         originals.setdefault(file_hash, mp3_path))
+            if original != mp3_path:
+                duplicates[mp3_path] = original
+
+        for dup_path, original in duplicates.items():
+            print(f'file {tree.real_path(dup_path)} is a duplicate of '
+                  f'{tree.real_path(original)}')
+        self.metrics.count('duplicates', len(duplicates))
+        if s.duplicates == 'report' or not duplicates:
+            return
+        if self.virtual:
+            for dup_path in duplicates:
+                self.manifest.record_exported(tree.real_path(dup_path))
+
+        dup_items = []
+        for d in self.album_dirs():
+            dir_path = f'{s.base_dir}/{d}'
+            dir_mp3s = [f for f in tree.walk_files(dir_path)
+                        if f.endswith('.mp3')]
+            if dir_mp3s and all(f in duplicates for f in dir_mp3s):
+                dup_items.append(dir_path)
+                for mp3_path in dir_mp3s:
+                    del duplicates[mp3_path]
+        dup_items.extend(duplicates)
+
+        for item_path in dup_items:
+            if s.duplicates == 'delete':
+                for file_path in (tree.walk_files(item_path, hidden=True)
+                                  if tree.is_dir(item_path) else
+                                  [item_path]):
+                    tree.remove(file_path)
+            else:
+                tree.rename(item_path, self.free_path(
+                  f'{s.base_dir}/{s.duplicates_dir}/'
+                  f'{item_path[len(s.base_dir) + 1:]}',
+                  tree.is_dir(item_path)))
+
+    def free_path(self, item_path, is_dir=False):
+        '''
+        Returns item_path, or the same path with ' (2)', ' (3)'... added
+        to the name when there is something there already, indexed or on
+        disk (left by an earlier run, maybe).
+        '''
+        parent, name = path.split(item_path)
+        stem, ext    = (name, '') if is_dir else path.splitext(name)
+        taken        = set(self.tree.listdir(parent))
+        n            = 1
+        while name in taken or path.lexists(f'{parent}/{name}'):
+            n   += 1
+            name = f'{stem} ({n}){ext}'
+        return f'{parent}/{name}'
+
+    def index_library(self, sizes):
+        '''
+        Returns {audio size: {audio hash: path}} of dest_dir tracks with
+        one of given audio sizes.
+
+        dest_dir is walked every time, but only new or changed tracks get
+        their audio size read, and only tracks of matching audio size get
+        hashed, once. Both are kept in manifest, so even a huge library
+        costs little more than a walk.
+        '''
+        indexed = self.manifest.library()
+        changed = {}
+        found   = {}
+
+        for root, dirs, files in walk(self.s.dest_dir):
+            for name in files:
+                if not name.endswith('.mp3'):
+                    continue
+                track_path = f'{root}/{name}'
+                file_stat  = stat(track_path)
+                entry      = indexed.pop(track_path, None)
+                if not entry or entry[:2] != [file_stat.st_size,
+                                              file_stat.st_mtime_ns]:
+                    entry = [file_stat.st_size, file_stat.st_mtime_ns,
+                             audio_size(track_path), None]
+                    changed[track_path] = entry
+
+                if entry[2] in sizes:
+                    if entry[3] is None:
+                        entry[3] = audio_hash(track_path)
+                        changed[track_path] = entry
+                        self.metrics.count('hashes')
+                    found.setdefault(entry[2], {})[entry[3]] = track_path
+
+        self.manifest.record_library(changed, gone=indexed)
+        self.manifest.commit()
+        return found
+
+    # Test/repair all mp3 files, move broken ones to broken_dir
+    def validate(self):
+        '''
+        Checks every mp3 file, repairs what can be repaired.
+
+        The built-in validator goes through each file once and fixes
+        common problems itself, files it can't handle go to mp3val if
+        it's enabled. With 'mp3val' validator every file goes to mp3val
+        and files eyed3 can't parse are broken. Checks run in up to jobs
+        processes, and so does mp3val, while results are gathered in this
+        thread, in original order. Files validated in earlier runs (the
+        same way) and unchanged since then are skipped; files the built-in
+        validator left to mp3val count as validated only by mp3val, so a
+        run which can start mp3val checks them again. Broken files are
+        moved only after all files are checked, so the outcome doesn't
+        depend on job count. Files are never repaired in a dry run, nor
+        in base_dir when they go to dest_dir as copies: their copies get
+        repaired instead.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        s, tree, manifest = self.s, self.tree, self.manifest
+        self.metrics.switch('validate')
+        builtin = s.validator == 'builtin'
+        mp3val  = s.enable_mp3val and not self.virtual
+
+        mp3_files    = [a for a in tree.walk_files(s.base_dir)
+                        if path.splitext(a)[1] == '.mp3']
+        valid_level  = 2 if builtin or mp3val else 1
+        to_validate  = [mp3_path for mp3_path in mp3_files
+                        if not manifest.is_validated(mp3_path, valid_level)]
+        if builtin:
+            statuses = self.check_streams(to_validate)
+        else:
+            statuses = dict.fromkeys(to_validate, 'unknown')
+        unhandled    = [mp3_path for mp3_path, status in statuses.items()
+                        if status == 'unknown']
+
+        if mp3val and unhandled:
+            print('mp3val enabled, fixing errors in files...')
+            with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as pool:
+                for mp3_path in pool.map(self.repair_mp3, unhandled):
+                    self.forget_mp3(mp3_path)
+                    if builtin:
+                        statuses[mp3_path] = self.stream_checked(
+                            mp3_path, *check_stream(mp3_path, fix=False))
+
+        broken_files = []
+        for mp3_path in to_validate:
+            self.metrics.count('files')
+            if builtin:
+                broken = statuses[mp3_path] == 'broken'
+            else:
+                broken = not self.load_mp3(mp3_path)
+
+            if broken:
+                broken_files.append(mp3_path)
+            elif statuses.get(mp3_path) == 'fixable' and self.virtual:
+                self.to_fix.add(mp3_path)  # only its copy gets fixed
+            elif statuses.get(mp3_path) == 'unknown' and not mp3val:
+                manifest.record(mp3_path, validated=1)  # not repaired
+            else:
+                manifest.record(mp3_path, validated=valid_level)
+        manifest.commit()
+
+        base_dir_slashes = s.base_dir.count('/')
+
+        for mp3_path in broken_files:
+            if self.virtual:
+                manifest.record_exported(mp3_path)
+            print((f'file {mp3_path} is broken, moving it to "{s.broken_dir}" '
+                    'subdirectory'))
+            mp3_path_slashes = mp3_path.count('/')
+            filename         = mp3_path.split('/')[-1]
+
+            if mp3_path_slashes   == base_dir_slashes + 1:  # single
+                tree.rename(mp3_path,
+                            f'{s.base_dir}/{s.broken_dir}/{filename}')
+
+            elif mp3_path_slashes == base_dir_slashes + 2:  # album
+                dir_of_file = '/'.join(mp3_path.split('/')[-2:-1])
+                tree.rename(f'{s.base_dir}/{dir_of_file}/{filename}',
+                            f'{s.base_dir}/{s.broken_dir}/{dir_of_file}/'
+                            f'{filename}')
+
+    def check_streams(self, mp3_files):
+        '''
+        Returns {path: status} of given files, checked by check_stream.
+
+        Checks are CPU-bound, so with more than one job they run in up to
+        jobs processes, unless files are too few megabytes to make up for
+        starting the processes. Files get fixed, unless base_dir is not to
+        be touched. Audio stats read on the way are kept for read_tags.
+        '''
+        fix        = not self.virtual
+        total_size = sum(self.tree.size(mp3_path) for mp3_path in mp3_files)
+        if self.jobs > 1 and len(mp3_files) > self.jobs and \
+           total_size > 64 << 20:
+            from concurrent.futures import ProcessPoolExecutor
+
+            chunk_size = max(len(mp3_files) // (self.jobs * 4), 1)
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                results = list(pool.map(check_stream, mp3_files,
+                                        [fix] * len(mp3_files),
+                                        chunksize=chunk_size))
+        else:
+            results = [check_stream(mp3_path, fix) for mp3_path in mp3_files]
+
+        return {mp3_path: self.stream_checked(mp3_path, *result)
+                for mp3_path, result in zip(mp3_files, results)}
+
+    def stream_checked(self, mp3_path, status, stats):
+        '''
+        Notes what check_stream found in a file, returns its status.
+        '''
+        if status == 'fixed':
+            self.forget_mp3(mp3_path)
+            self.metrics.count('repairs')
+        if stats is not None:
+            file_stat = stat(mp3_path)
+            self.streams[mp3_path] = ((file_stat.st_size,
+                                       file_stat.st_mtime_ns), stats)
+        return status
+
+    # Rename mp3 subdirs to enumerated CD dirs, move relevant imgs from
+    # subdirs to album dir, delete everything else
+    def flatten(self):
+        '''Leaves every album directory with no subdirectories.'''
+        s, tree = self.s, self.tree
+        self.metrics.switch('scan')
+
+        self.curr_file        = 0
+        self.total_n_of_files = self.eval_total_files()
+
+        for d in self.album_dirs():
+            subdirs = tree.subdirs(f'{s.base_dir}/{d}', hidden=True)
+
+            cd_num = 0
+            for sub in subdirs:
+                sub_path        = f'{s.base_dir}/{d}/{sub}'
+                sub_parent_path = f'{s.base_dir}/{d}'
+                subdir_files    = tree.files(sub_path)
+                subdir_mp3s     = [f for f in subdir_files
+                                   if f.endswith('.mp3')]
+                subdir_imgs     = ([f for f in subdir_files
+                                    if f.endswith('.jpg')] +
+                                   [f for f in subdir_files
+                                    if f.endswith('.png')])
+
+                if subdir_mp3s:
+                    cd_num += 1
+                    last_slash = sub_path.rfind('/')
+                    cdp = (f'{sub_path[:last_slash]} '
+                           f'{sub_path[last_slash+1:]}.CD{cd_num}')
+                    tree.rename(sub_path, cdp)
+                    self.move_cached(sub_path, cdp)
+                    if tree.is_dir(sub_parent_path) and \
+                       not tree.listdir(sub_parent_path, hidden=False):
+                        tree.rmdir(sub_parent_path)
+
+                elif subdir_imgs:
+                    for filename in subdir_imgs:
+                        tree.rename(f'{sub_path}/{filename}',
+                                    f'{sub_parent_path}/{filename}')
+
+                elif not subdir_mp3s and not subdir_imgs:
+                    tree.rmdir(sub_path)
+
+    # Sort out album images:
+    # * renames jpegs to jpgs, deletes images that are too small
+    # * converts and compresses images of all albums at once, in up to
+    #   jobs workers; images compressed before, in any album, are taken
+    #   from image cache
+    # * renames images according to their probable content
+    def sort_images(self):
+        '''Leaves each album with compressed, well-named jpg images.'''
+        from concurrent.futures import ThreadPoolExecutor
+
+        s, tree, manifest = self.s, self.tree, self.manifest
+        self.metrics.switch('images')
+
+        album_imgs = {}
+        n_of_imgs  = {}
+
+        for d in self.album_dirs():
+            dir_path  = f'{s.base_dir}/{d}'
+            dir_files = tree.listdir(dir_path)
+
+            if not [f for f in dir_files if f.split('.')[-1] == 'mp3']:
+                continue
+
+            for f in dir_files:
+                if '.jpeg' in f:
+                    src_path     = f'{dir_path}/{f}'
+                    new_filename = re.sub('\.jpeg', '.jpg', f)
+                    dest_path    = f'{dir_path}/{new_filename}'
+                    tree.rename(src_path, dest_path)
+
+            dir_imgs      = [name for name in tree.listdir(dir_path)
+                             if '.jpg' in name or '.png' in name]
+            n_of_imgs[d]  = len(dir_imgs)
+            album_imgs[d] = []
+
+            for f in dir_imgs:
+                self.report_current(f)
+                f_path = f'{dir_path}/{f}'
 
-    with NoStdErr():
-        if s.write_to_v1:
-            parsed.tag.save(filename=src_path, version=(1,1,0))
-        if s.write_to_v2:
-            parsed.tag.save(filename=src_path, version=s.tag_v2_version)
+                file_size = tree.size(f_path)
+                if file_size < s.img_min_size:
+                    print(f' {f} file size is too small, deleting...')
+                    tree.remove(f_path)
+                    continue
+
+                album_imgs[d].append(f_path)
+
+            if s.img_conv_compr:
+                album_imgs[d] = self.free_jpg_names(dir_path, album_imgs[d])
+
+        if s.img_conv_compr:
+            done_imgs = {img_path for imgs in album_imgs.values()
+                         for img_path in imgs
+                         if manifest.has_image(tree.real_path(img_path))}
+            compress  = planned_img if self.virtual else self.compress_cached
+            if not self.virtual:
+                self.load_img_cache()
+
+            with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as pool:
+                compressed = {d: pool.map(compress, [i for i in imgs
+                                                     if i not in done_imgs])
+                              for d, imgs in album_imgs.items()}
+                compressed = {d: iter(list(imgs))
+                              for d, imgs in compressed.items()}
+
+            for d, imgs in album_imgs.items():
+                album_imgs[d] = [img_path if img_path in done_imgs
+                                 else next(compressed[d]) for img_path in imgs]
+
+                for img_path, compressed_path in zip(imgs, album_imgs[d]):
+                    if img_path not in done_imgs:
+                        tree.rewritten(img_path, compressed_path)
+                    if not self.virtual:
+                        manifest.record_image(compressed_path)
+            manifest.commit()
+            if self.img_cache:
+                self.img_cache.commit()
+
+        for d, imgs in album_imgs.items():
+            dir_path     = f'{s.base_dir}/{d}'
+            img_iter     = 0
+            front_exists = False
+            back_exists  = False
+
+            for f_path in imgs:
+                f = f_path.split('/')[-1]
+
+                if n_of_imgs[d] == 1 and f != 'front.jpg':
+                    self.rename_img(dir_path, f, 'front')
+                    front_exists = True
+
+                else:
+                    if not front_exists and ('front' in f or 'folder' in f):
+                        self.rename_img(dir_path, f, 'front')
+                        front_exists = True
+
+                    elif not back_exists and 'back' in f:
+                        self.rename_img(dir_path, f, 'back')
+                        back_exists = True
+
+                    else:
+                        img_iter      +=1
+                        img_iter_final = (f'0{img_iter}'
+                                          if len(str(img_iter)) == 1
+                                          else img_iter)
+                        self.rename_img(dir_path, f,
+                                        f"album-art-{img_iter_final}")
+
+    # Tags to yaml file:
+    # * reads tag information of all single and album files, does minor
+    #   corrections, appends records of album images
+    # * runs a series of string corrections on values missing from title
+    #   cache, remembers the results
+    # * streams corrected records to tag changes file, prompts user to
+    #   edit it
+    def extract(self):
+        '''
+        Returns tag changes records of single files, then of album
+        files, read one at a time as they are used.
+        '''
+        self.metrics.switch('extract')
+        self.load_corrections()
+        self.title_cache.hits   = 0
+        self.title_cache.misses = 0
+
+        files = self.tree.files(self.s.base_dir, hidden=True)
+        return self.extract_records(files, self.album_dirs())
+
+    def load_corrections(self):
+        '''
+        Compiles correction rules and opens title cache, on first run
+        that has any tags to correct.
+        '''
+        if self.rules is not None:
+            return
+        s = self.s
+
+        self.rules       = compile_rules(self.regexes)
+        fingerprint      = repr([2, s.enable_nlp, s.nlp_model,
+                                 *self.regexes.items()])
+        fingerprint      = hashlib.sha1(fingerprint.encode()).hexdigest()
+        self.title_cache = TitleCache(s.title_cache_file, s.title_cache_size,
+                                      fingerprint, read_only=bool(self.plan))
+
+    def load_img_cache(self):
+        '''Opens image cache, on first run that compresses any image.'''
+        s = self.s
+        if self.img_cache is not None or not s.img_cache_dir:
+            return
+
+        fingerprint    = repr([s.img_backend, s.jpg_compr_lvl])
+        self.img_cache = ImageCache(s.img_cache_dir, s.img_cache_size << 20,
+                                    fingerprint)
+
+    def review(self, records):
+        '''
+        Turns corrected records into a list of planned moves.
+
+        Records go to tag changes file, which the user can edit before
+        moves are planned from it. Dry run plans moves straight from
+        records, with errors instead of exiting on bad fields.
+        '''
+        s = self.s
+
+        if self.plan:
+            moves = self.plan_moves(records, strict=False)
+        else:
+            write_records(s.tag_changes_file, records)
+        self.title_cache.commit()
+        self.manifest.commit()
+
+        if s.text_editor and not self.plan and not self.unattended:
+            self.metrics.switch(None)
+            run([s.text_editor, s.tag_changes_file])
+            input('\nFinished correcting the file? Press ENTER...')
+        self.metrics.switch('save')
+
+        if not self.plan:
+            print('\nSaving tags, moving files...')
+            moves = self.plan_moves(read_records(s.tag_changes_file))
+        return moves
+
+    # Save tags, move files:
+    # * write the plan down to journal before touching anything
+    # * parse mp3 files and save tags to them, in parallel
+    # * rename files, move them to newly-created directories, or put
+    #   their copies there, as set in output_mode
+    # * in dry run, files are only moved (or copied) in the index
+    def apply(self, moves):
+        '''Carries out planned moves.'''
+        s, tree = self.s, self.tree
+
+        # Tracks get new tags, which hardlinks would give originals too
+        if s.output_mode != 'move':
+            for move in moves:
+                move['mode'] = s.output_mode
+                if move['tags'] is not None and s.output_mode == 'hardlink':
+                    move['mode'] = 'reflink'
+
+        if self.plan:
+            for move in moves:
+                if move['dest'] and s.output_mode == 'move':
+                    tree.rename(move['src'], move['dest'])
+                elif move['dest']:
+                    tree.copy(move['src'], move['dest'], move['mode'])
+            return
+
+        # Copies are made from files where they really are, which get
+        # repaired and compressed on the way if they need it
+        if s.output_mode != 'move':
+            for move in moves:
+                move['src'] = tree.real_path(move['src'])
+                if move.get('cover'):
+                    move['cover'][0] = tree.real_path(move['cover'][0])
+                if move['tags'] is not None:
+                    move['fix'] = move['src'] in self.to_fix
+                else:
+                    move['compress'] = (s.img_conv_compr and not
+                                        self.manifest.has_image(move['src']))
+
+        self.journal.write(moves)
+        self.tags_saved = self.run_moves(moves)
+        self.journal.remove()
+
+    def clean_up(self):
+        '''Removes remaining empty folders.'''
+        tree = self.tree
+
+        for d in tree.subdirs(self.s.base_dir, hidden=True):
+            dir_path = f'{self.s.base_dir}/{d}'
+
+            if not tree.listdir(dir_path):
+                tree.rmdir(dir_path)
+
+    def load_mp3(self, filepath):
+        '''
+        Parses an mp3 file with eyed3, reusing earlier parse if possible.
+
+        Parsed files are kept in mp3_cache for the whole run, keyed by path
+        and checked against file size and modification time, so each file's
+        headers and frames are decoded just once no matter how many stages
+        need them.
+        '''
+        file_stat = stat(filepath)
+        file_key  = (file_stat.st_size, file_stat.st_mtime_ns)
+        cached    = self.mp3_cache.get(filepath)
+
+        if cached and cached[0] == file_key:
+            return cached[1]
+        import eyed3
+
+        with NoStdErr():
+            parsed = eyed3.load(filepath)
+        self.metrics.count('loads')
+        self.mp3_cache[filepath] = (file_key, parsed)
+        return parsed
+
+    def read_tags(self, filepath):
+        '''
+        Returns raw tag data of an mp3 file, as much as tag_to_record needs.
+
+        Data read once in a run is kept for the rest of it, as long as the
+        file doesn't change, so a dry run (with read only manifest) or a
+        full one (which doesn't trust it) parse each tag just once too.
+        Otherwise data comes from the manifest when the file hasn't
+        changed since its tags were last read, or the tag is parsed,
+        length and bitrate of audio come from validation or are read by
+        audio_stats, and the data gets recorded for next runs.
+        '''
+        filepath  = self.tree.real_path(filepath)
+        file_stat = stat(filepath)
+        file_key  = (file_stat.st_size, file_stat.st_mtime_ns)
+        cached    = self.tags_read.get(filepath)
+        if cached and cached[0] == file_key:
+            return cached[1]
+
+        tags = self.manifest.tags(filepath)
+        # Snapshots from older versions lack album artist, disc or bitrate
+        if tags is not None and 'kbps' in tags:
+            self.tags_read[filepath] = (file_key, tags)
+            return tags
+
+        tag = self.load_tag(filepath)
+        with NoStdErr():
+            date = tag.getBestDate()
+        tags = {'album_artist': tag.album_artist,
+                'artist':       tag.artist,
+                'album':        tag.album,
+                'title':        tag.title,
+                'date':         str(date) if date is not None else None,
+                'track_num':    tag.track_num[0],
+                'disc':         tag.disc_num[0]}
+        stream = self.streams.get(filepath)
+        if stream and stream[0] == file_key:
+            tags.update(stream[1])
+        else:
+            tags.update(audio_stats(filepath))
+        self.manifest.record(filepath, tags=tags)
+        self.tags_read[filepath] = (file_key, tags)
+        return tags
+
+    def load_tag(self, filepath):
+        '''
+        Returns ID3 tag of an mp3 file, an empty one if it has none.
+
+        Earlier parse of the whole file is reused if there is one,
+        otherwise only the tag is parsed, audio frames are left alone.
+        '''
+        file_stat = stat(filepath)
+        cached    = self.mp3_cache.get(filepath)
+        if cached and cached[0] == (file_stat.st_size, file_stat.st_mtime_ns):
+            if cached[1].tag is None:
+                cached[1].initTag()
+            return cached[1].tag
+        import eyed3.id3
+
+        tag = eyed3.id3.Tag()
+        with NoStdErr():
+            tag.parse(filepath)
+        self.metrics.count('loads')
+        return tag
+
+    def save_tags(self, tag, filepath, src_path=None):
+        '''
+        Saves ID3v2 and ID3v1 tags to a file, as set in settings.
+
+        When the new ID3v2 tag fits into the old one, padding included, it
+        is written over it in place. Otherwise the file is rewritten once,
+        into a temporary file next to it which then replaces the original,
+        audio being copied by copy_range. Given src_path, the file is
+        written anew just the same way, from the tag and audio of the
+        file at src_path, which stays as it was. ID3v1 tag always goes in
+        place, over the last 128 bytes or right after them. Returns True
+        when the new ID3v2 tag didn't fit into the old one.
+
+        Rendering and ID3v1 writing go through eyed3 internals (checked
+        against eyed3 0.9.x); with an eyed3 that lacks them, tags are
+        saved by its public Tag.save instead, the copy for src_path made
+        first.
+        '''
+        import eyed3.id3
+
+        if not (hasattr(tag, '_render') and hasattr(tag, '_saveV1Tag') and
+                hasattr(eyed3.id3, 'FileInfo')):
+            return self.save_tags_public(tag, filepath, src_path)
+        rewritten   = False
+        source_path = src_path or filepath
+
+        if self.s.write_to_v2:
+            with open(source_path, 'rb') as f:
+                curr_tag_size = id3v2_size(f.read(10))
+
+            tag.version = self.s.tag_v2_version
+            try:
+                rewritten, tag_data, padding = tag._render(
+                  self.s.tag_v2_version, curr_tag_size, None)
+            except TypeError:  # signature changed, nothing written yet
+                return self.save_tags_public(tag, filepath, src_path)
+            if rewritten or src_path:
+                with open(source_path, 'rb') as src, \
+                     NamedTemporaryFile('wb', dir=path.dirname(filepath),
+                                        delete=False) as tmp_file:
+                    tmp_file.write(tag_data + padding)
+                    copy_range(src, tmp_file, curr_tag_size)
+                copymode(source_path, tmp_file.name)
+                replace(tmp_file.name, filepath)
+            else:
+                with open(filepath, 'r+b') as f:
+                    f.write(tag_data + padding)
+        elif src_path:
+            place_file(src_path, filepath)
+
+        if self.s.write_to_v1:
+            tag.file_info = eyed3.id3.FileInfo(filepath)
+            tag._saveV1Tag((1,1,0))
+
+        self.forget_mp3(filepath)
+        self.metrics.count('saves')
+        if rewritten:
+            self.metrics.count('rewrites')
+        return rewritten
+
+    def save_tags_public(self, tag, filepath, src_path=None):
+        '''
+        Saves tags like save_tags, but only by public eyed3 API, which
+        may rewrite the file again after a copy is made.
+        '''
+        if src_path:
+            place_file(src_path, filepath)
+        with open(filepath, 'rb') as f:
+            curr_tag_size = id3v2_size(f.read(10))
+
+        if self.s.write_to_v2:
+            tag.save(filepath, version=self.s.tag_v2_version)
+        if self.s.write_to_v1:
+            tag.save(filepath, version=(1,1,0))
+
+        with open(filepath, 'rb') as f:
+            rewritten = id3v2_size(f.read(10)) != curr_tag_size
+        self.forget_mp3(filepath)
+        self.metrics.count('saves')
+        if rewritten:
+            self.metrics.count('rewrites')
+        return rewritten
+
+    def forget_run(self):
+        '''
+        Drops what was cached about files during a run, so that a watcher
+        running one pass after another doesn't keep it all.
+        '''
+        self.mp3_cache       = {}
+        self.tags_read       = {}
+        self.streams         = {}
+        self.manifest.hashes = {}
+
+    def forget_mp3(self, filepath):
+        '''
+        Drops cached parse and audio hash of a file that was rewritten on
+        disk.
+        '''
+        self.mp3_cache.pop(filepath, None)
+        self.manifest.hashes.pop(filepath, None)
+
+    def move_cached(self, src_path, dest_path):
+        '''
+        Re-keys cached parses and manifest entries after a file or directory
+        got renamed.
+        '''
+        if self.tree.virtual:  # files stay where they are
+            return
+        for cache in (self.mp3_cache, self.tags_read, self.streams):
+            moved = [p for p in cache
+                     if p == src_path or p.startswith(f'{src_path}/')]
+            for p in moved:
+                cache[dest_path + p[len(src_path):]] = cache.pop(p)
+        self.manifest.move(src_path, dest_path)
+
+    def report_current(self, filename):
+        '''Prints which file is being worked and total queue size.'''
+        self.curr_file        += 1
+        self.metrics.count('files')
+        total_n_of_files       = self.total_n_of_files
+        len_of_total_files_str = len(str(total_n_of_files))
+        format_pre_str         = '{:' + str(len_of_total_files_str) + '}'
+        curr_file_formatted    = format_pre_str.format(self.curr_file)
+
+        print(f' [{curr_file_formatted}/{total_n_of_files}]  {filename}')
+
+    def eval_total_files(self):
+        '''Counts all files to be edited in the base_dir directory'''
+        s = self.s
+        n = 0
+
+        for (root, names) in self.tree.entries.items():
+            if not s.broken_dir in root and not s.notmp3_dir in root and \
+               not s.duplicates_dir in root:
+                n += len([size for size in names.values()
+                          if size is not None])
+
+        if not n:
+            raise ValueError(
+              f'No mp3 files found in {s.base_dir}. Add something '
+              ' (or change the path in program settings) and then start '
+              'the program. Exiting...')
+        return n
+
+    def tag_to_record(self, filepath, category='single', album_artist=None,
+                      album_time=0, artist_has_comma=False):
+        '''
+        Reads tag information and returns it as tag changes record.
+
+        Extracts file information from an mp3 file, does minor corrections
+        and returns them as a TrackRecord. The 'category'
+        argument can be either 'single' or 'album', indicating which type
+        of file is being worked (album needs few extra steps). Albums need
+        album_artist too, while album_time (in seconds) and artist_has_comma
+        tell how long the album is and if its artist name has a comma.
+        '''
+        def tag_to_str(tag):
+            '''Simple string cleaner'''
+            if tag is None:
+                return ''
+            tag = str(tag)
+            if tag == tags['title']:
+                if self.s.roman_to_arabic:
+                    tag = romantoarabic(tag)
+            tag = tag.strip().lower()
+            return tag
+
+        if category == 'album' and album_artist is None:
+            raise ValueError(
+              'For "album" category, you also need to pass album_artist '
+              'keyword argument like so:\n tag_to_record(path/to/file, '
+              '"album", album_artist="some string". Exiting...')
 
-    report_current(filename)
+        file = path.basename(filepath)
 
-    parsed.tag.album = parsed.tag.album.replace('/',' # ').replace('  ', ' ')
-    parsed.tag.title = parsed.tag.title.replace('/',' # ').replace('  ', ' ')
+        tags   = self.read_tags(filepath)
+        date   = str(tag_to_str(tags['date']))[:4]
+        artist = tag_to_str(tags['artist'])
+        album  = tag_to_str(tags['album'])
+        title  = tag_to_str(tags['title'])
 
-    if len(parsed.tag.title) > 80:
-        parsed.tag.title = f'{parsed.tag.title[:80]}(...)'
+        if tags['track_num']:
+            track_num = str(tags['track_num'])
+        else:
+            try:
+                track_num = TRACK_NUM_RGX.search(file[:5])[0]
+            except (IndexError, TypeError):
+                track_num = ''
+
+        if self.feat_rgx.search(artist):
+            artist = self.feat_rgx.sub(',', artist)
+
+        if self.feat_rgx.search(title):
+            extra_artists = self.feat_tail_rgx.search(title)[0]
+            extra_artists = self.feat_rgx.sub('', extra_artists)
+            extra_artists = extra_artists.rstrip(']) ')
+            extra_artists = extra_artists.replace(', ', ',')
+            title         = self.feat_tail_rgx.sub('', title)
+            artist        = artist + ',' + extra_artists
+
+        if category == 'album' and not artist_has_comma:
+            artist = artist.replace(', ', ',')
+
+        if category == 'album' and EP_SUFFIX_RGX.search(album):
+            album = EP_SUFFIX_RGX.sub('', album)
+
+        if self.s.ep_eval:
+            ep_conditions = (category == 'album'
+                             and album_time < self.s.ep_max_length
+                             and not EP_WORD_RGX.search(album))
+            if ep_conditions:
+                album = f'{album} EP'
+
+        title = title.replace('"', '\'')
+
+        if album_artist is not None:
+            album_artist = album_artist.strip().lower()
+
+        return TrackRecord(artist, album, title, date, track_num, filepath,
+                           album_artist=album_artist)
+
+    def extract_records(self, files, dirs):
+        '''
+        Yields tag changes records of single files, then of album files.
+
+        Loose files sharing album tags are clustered into albums first,
+        no matter how the library is laid out. Each directory album's
+        track records are followed by records of its images, which end up
+        in the same directory as the album.
+        '''
+        s = self.s
+
+        tracks = [(f'{s.base_dir}/{file}',
+                   self.read_tags(f'{s.base_dir}/{file}')) for file in files]
+        singles, albums = cluster_tracks(tracks, s.album_min_tracks,
+                                         self.feat_rgx)
+
+        for file_path in singles:
+            self.report_current(path.basename(file_path))
+            yield self.tag_to_record(file_path)
+
+        for discs in albums:
+            yield from self.album_records(discs)
+
+        for d in dirs:
+            dir_path  = f'{s.base_dir}/{d}'
+            dir_files = self.tree.listdir(dir_path)
+
+            mp3_files = [f'{dir_path}/{f}' for f in dir_files
+                         if f.split('.')[-1] == 'mp3']
+            if not mp3_files:
+                print(f'folder "{d}" does not contain any mp3 files, '
+                      'skipping')
+                continue
+
+            # Discs split into directories by flatten are numbered by their
+            # names, discs of one directory by their tags
+            cd_dir = CD_DIR_RGX.search(d)
+            if cd_dir:
+                discs = {int(cd_dir[1]): mp3_files}
+            else:
+                discs = {}
+                for mp3_path in mp3_files:
+                    disc = self.read_tags(mp3_path)['disc'] or 1
+                    discs.setdefault(disc, []).append(mp3_path)
+                discs = (dict(sorted(discs.items())) if len(discs) > 1
+                         else {None: mp3_files})
+            yield from self.album_records(discs)
+
+            for name in self.tree.listdir(dir_path):
+                if '.jpg' in name:
+                    yield ImageRecord(f'{dir_path}/{name}')
+
+    def album_records(self, discs):
+        '''
+        Yields tag changes records of one album's tracks.
+
+        Discs are {disc number: [paths]}, with None for the only disc of
+        a single-disc album. The whole album is read once to get its
+        length and artist name before any record is made.
+        '''
+        s = self.s
+
+        artist_tags      = []
+        album_artists    = set()
+        album_time       = 0
+        artist_has_comma = False
+
+        # First full iteration: calculate album length, gather artist
+        # names
+        for mp3_files in discs.values():
+            for mp3_path in mp3_files:
+                tags = self.read_tags(mp3_path)
+                artist_tags.append(str(tags['artist']))
+                album_artists.add(tags['album_artist'])
+                if s.ep_eval:
+                    album_time += tags['time_secs']
+
+        artist_tags.sort(key=len)
+        # Album artist tag shared by all tracks beats the shortest artist
+        if len(album_artists) == 1 and None not in album_artists:
+            artist_tags.insert(0, album_artists.pop())
+
+        if ', ' in artist_tags[0]:
+            artist_has_comma = True
+
+        # Second interation: correct tags
+        for disc, mp3_files in discs.items():
+            for mp3_path in mp3_files:
+                self.report_current(path.basename(mp3_path))
+                record = self.tag_to_record(mp3_path, 'album',
+                                            album_artist=artist_tags[0],
+                                            album_time=album_time,
+                                            artist_has_comma=artist_has_comma)
+                if disc is not None:
+                    record.disc = str(disc)
+                yield record
+
+    def correct(self, records):
+        '''
+        Yields tag changes records with corrected values.
+
+        Works on batches of records: values missing from title cache get
+        capitalized and corrected, each unique value once, then stored
+        in the cache. Paths are left as they are.
+        '''
+        for batch in iter(lambda: list(islice(records, 1000)), []):
+            raw_vals  = list(dict.fromkeys(
+                          val for record in batch
+                          for key, val in record.tag_fields() if val))
+            corrected = self.title_cache.get_many(raw_vals)
+            missing   = [val for val in raw_vals if val not in corrected]
+
+            stage = self.metrics.switch('capitalize')
+            if self.s.enable_nlp:
+                capitalized = self.nlp_capitalize(missing)
+            else:
+                capitalized = [val.title() for val in missing]
+
+            self.metrics.switch('regex')
+            self.metrics.count('values', len(missing))
+            corrected.update(zip(missing, correct_values(capitalized,
+                                                         self.rules)))
+            self.metrics.switch(stage)
+            self.title_cache.put_many({val: corrected[val]
+                                       for val in missing})
+
+            for record in batch:
+                for key, val in record.tag_fields():
+                    if val:
+                        attr = record.KEYS[key]
+                        setattr(record, attr, corrected[val])
+                yield record
+
+    def plan_moves(self, records, strict=True):
+        '''
+        Turns tag changes records into a list of planned moves.
+
+        Nothing is touched yet: all records are checked first, so a blank
+        or malformed field stops the program before any file is saved or
+        moved. Each move has source and destination paths, plus eyed3 tag
+        fields to save for tracks. Tracks with a disc number go to a CD
+        subdirectory of their album. Images go to the directory of the
+        album track right before them. When not strict, tracks with bad
+        fields get an error and no destination instead. With embed_front
+        set, tracks of an album with front.jpg get its source and
+        destination path, to embed it in their tags. Tracks belong to the
+        album they come from, wherever their tags send them.
+        '''
+        import eyed3
+
+        s           = self.s
+        moves       = []
+        final_dir   = None
+        album_moves = {}  # source album directory: moves of its tracks
+        album_depth = s.base_dir.count('/') + 2
+
+        for record in records:
+            src_path  = record.path
+            filename  = src_path.split('/')[-1]
+            src_album = '/'.join(src_path.split('/')[:album_depth])
+
+            if isinstance(record, ImageRecord):
+                dest_path = f'{final_dir}/{filename}'
+                moves.append({'src': src_path, 'dest': dest_path,
+                              'tags': None})
+                if s.embed_front and filename == 'front.jpg':
+                    for track_move in album_moves.get(src_album, ()):
+                        track_move['cover'] = [src_path, dest_path]
+                continue
+
+            tags = {'artist': record.artist, 'album': record.album,
+                    'title': record.title, 'recording_date': record.date,
+                    'track_num': record.track_num}
+            if record.is_album:
+                tags['album_artist'] = record.album_artist
+            if record.disc:
+                tags['disc_num'] = record.disc
+
+            error = None
+            if not all(val for key, val in record.tag_fields()):
+                error = 'at least one tag field in file was left blank'
+            else:
+                try:
+                    track_num = int(record.track_num)
+                    disc      = int(record.disc or 0)
+                    date      = str(eyed3.core.Date.parse(record.date))
+                except ValueError:
+                    error = (f'invalid track number, disc or date of '
+                             f'"{src_path}"')
+
+            if error and strict:
+                print(f'Error: {error}. Exiting...')
+                sys.exit()
+            elif error:
+                moves.append({'src': src_path, 'dest': None, 'tags': tags,
+                              'error': error})
+                continue
+
+            album = record.album.replace('/',' # ').replace('  ', ' ')
+            title = record.title.replace('/',' # ').replace('  ', ' ')
+
+            if len(title) > 80:
+                title = f'{title[:80]}(...)'
+
+            if not record.is_album:
+                dest_path = f'{s.dest_dir}/{record.artist} - {title}.mp3'
 
-    if len(tag_stripe) == 6:  # single track
-        dest_name = f'{parsed.tag.artist} - {parsed.tag.title}.mp3'
-        renames(src_path, f'{s.dest_dir}/{dest_name}')
+            else:
+                t_no = str(track_num)
+                if len(t_no) == 1:
+                    t_no = f'0{t_no}'
+
+                dest_name         = f'{t_no} {title}.mp3'
+                dest_album_folder = (f'{record.album_artist} - {date} - '
+                                     f'{album}')
+                final_dir         = f'{s.dest_dir}/{dest_album_folder}'
+
+                if disc:
+                    final_dir = f'{s.dest_dir}/{dest_album_folder}/CD{disc}'
+
+                dest_path = f'{final_dir}/{dest_name}'
+
+            moves.append({'src': src_path, 'dest': dest_path, 'tags': tags})
+            if record.is_album:
+                album_moves.setdefault(src_album, []).append(moves[-1])
+
+        return moves
+
+    def save_and_move(self, moves):
+        '''
+        Saves tags and moves files of one batch of planned moves.
+
+        Runs in a worker thread. Moves already done by an interrupted run
+        (source gone, destination in place) are skipped, copies are just
+        made again. Original tags of tracks to be moved are written down
+        in the journal first, all of the batch at once. Returns a list of
+        (move number, True if file was rewritten, None for skipped moves
+        and images).
+        '''
+        results = []
+        self.journal.write_tags({n: tag_bytes(move['src'])
+                                 for n, move in moves
+                                 if move.get('mode', 'move') == 'move' and
+                                    move['tags'] is not None and
+                                    path.exists(move['src'])})
+
+        for n, move in moves:
+            src_path, dest_path = move['src'], move['dest']
+            mode                = move.get('mode', 'move')
+
+            if not path.exists(src_path):
+                if mode != 'move' or not path.exists(dest_path):
+                    print(f'"{src_path}" is missing, skipping')
+                results.append((n, None))
+                continue
+
+            if mode != 'move':
+                results.append((n, self.export(move)))
+                continue
+
+            rewritten = None
+            if move['tags'] is not None:
+                rewritten = self.save_tags(self.new_tag(move), src_path)
+
+            with self.tree_lock:
+                self.tree.rename(src_path, dest_path)
+            results.append((n, rewritten))
+
+        return results
+
+    def export(self, move):
+        '''
+        Puts a copy of a file at destination of a planned move, leaving
+        the file itself alone.
+
+        Track copies are written just once, with new tags, unless they
+        can be reflinked: then tags are saved to the reflinked copy, so
+        only blocks of the tag get new space. Files that were found
+        fixable get repaired, images that need it get compressed, both
+        in their copies. Images which get compressed are reflinked
+        instead of hardlinked, so that originals stay as they are.
+        Returns what save_tags does, None for images.
+        '''
+        src_path, dest_path, mode = move['src'], move['dest'], move['mode']
+
+        if move['tags'] is None:
+            if not move.get('compress'):
+                used = place_file(src_path, dest_path, mode)
+            else:
+                img_path = dest_path
+                if src_path.endswith('.png'):
+                    img_path = re.sub('\.jpg$', '.png', dest_path)
+                used = place_file(src_path, img_path, ('reflink'
+                                                      if mode == 'hardlink'
+                                                      else mode))
+                img_path = self.compress_cached(img_path)
+                if img_path != dest_path:
+                    replace(img_path, dest_path)
+            self.metrics.count('copies' if used == 'copy' else f'{used}s')
+            return None
+
+        tag = self.new_tag(move)
+        # A file which can't be reflinked is copied once, with new tags,
+        # never copied first and then rewritten
+        if mode == 'reflink' and \
+           place_file(src_path, dest_path, 'reflink', fallback=False):
+            rewritten = self.save_tags(tag, dest_path)
+            self.metrics.count('reflinks')
+        else:
+            makedirs(path.dirname(dest_path), exist_ok=True)
+            rewritten = self.save_tags(tag, dest_path, src_path)
+            self.metrics.count('copies')
+        self.forget_mp3(src_path)
+
+        if move.get('fix') and check_stream(dest_path)[0] == 'fixed':
+            self.metrics.count('repairs')
+        return rewritten
+
+    def new_tag(self, move):
+        '''
+        Returns tag of a track, made anew from fields of its planned move,
+        with album's front cover embedded if the move has one.
+        '''
+        tag = self.load_tag(move['src'])
+        tag.clear()
+        for field, val in move['tags'].items():
+            setattr(tag, field, val)
+
+        if move.get('cover'):
+            from eyed3.id3.frames import ImageFrame
+
+            cover = self.cover_art(*move['cover'])
+            if cover:
+                tag.images.set(ImageFrame.FRONT_COVER, cover, 'image/jpeg')
+        return tag
 
-    elif len(tag_stripe) == 7:
-        t_no = str(parsed.tag.track_num[0])
-        if len(t_no) == 1:
-            t_no = f'0{t_no}'
+    def cover_art(self, src_path, dest_path):
+        '''
+        Returns JPEG data of a front cover to embed in tags, made once
+        per album by cover_art and reused for all its tracks. The cover
+        is read from where it is at the moment: not moved yet, or already
+        moved by an interrupted run. None if it's neither.
+        '''
+        with self.covers_lock:
+            if src_path not in self.covers:
+                img_path = src_path if path.exists(src_path) else dest_path
+                self.covers[src_path] = (cover_art(img_path,
+                                                   self.s.embed_front_size,
+                                                   self.s.jpg_compr_lvl)
+                                         if path.exists(img_path) else None)
+            return self.covers[src_path]
+
+    def run_moves(self, moves, done=()):
+        '''
+        Carries out planned moves not done yet, over a thread pool.
+
+        Moves are batched by destination directory, so each batch creates
+        its directory once and files of one album land together. Workers
+        only save and move files; manifest, progress and journal are updated
+        in this thread, in original order of batches. Returns numbers of
+        files with tags saved in place and with a full rewrite.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.curr_file        = 0
+        self.total_n_of_files = len(moves)
+        in_place              = 0
+        rewritten             = 0
+
+        if any(move.get('compress') for move in moves):
+            self.load_img_cache()
+
+        batches = {}
+        for n, move in enumerate(moves):
+            if n not in done:
+                dest_dir = path.dirname(move['dest'])
+                batches.setdefault(dest_dir, []).append((n, move))
+
+        # Loose tracks share one destination directory, so big batches are
+        # split up to keep all workers busy
+        batches = [batch[i:i + 50] for batch in batches.values()
+                   for i in range(0, len(batch), 50)]
+
+        with NoStdErr(), ThreadPoolExecutor(max_workers=max(self.jobs, 1)) \
+                as pool:
+            for results in pool.map(self.save_and_move, batches):
+                for n, was_rewritten in results:
+                    move   = moves[n]
+                    copied = move.get('mode', 'move') != 'move'
+                    self.report_current(move['src'].split('/')[-1])
+                    if was_rewritten is None and move['tags'] is not None:
+                        continue
+                    if move['tags'] is None:
+                        if not copied:
+                            self.manifest.move(move['src'], move['dest'])
+                        continue
+                    if copied:
+                        self.manifest.record_exported(move['src'],
+                                                      move['dest'])
+                    else:
+                        self.manifest.record_moved(move['src'], move['dest'])
+                    if was_rewritten:
+                        rewritten += 1
+                    else:
+                        in_place  += 1
+                self.journal.mark_done([n for n, _ in results])
+
+        self.manifest.commit()
+        if self.img_cache:
+            self.img_cache.commit()
+        self.covers = {}
+        return in_place, rewritten
+
+    def rollback_moves(self, moves, originals):
+        '''
+        Moves files of an interrupted run back where they came from.
+
+        Tracks get back tags they had, as written down in the journal
+        before new ones were saved. Copies are removed, as originals are
+        still in place, and so are directories in dest_dir they leave
+        empty.
+        '''
+        for n, move in reversed(list(enumerate(moves))):
+            src_path, dest_path = move['src'], move['dest']
+            if move.get('mode', 'move') != 'move':
+                if path.exists(dest_path) and path.exists(src_path):
+                    print(f'removing copy "{dest_path}"')
+                    remove(dest_path)
+                    self.manifest.unexport(src_path, dest_path)
+                    dir_path = path.dirname(dest_path)
+                    try:
+                        while dir_path.startswith(f'{self.s.dest_dir}/'):
+                            rmdir(dir_path)
+                            dir_path = path.dirname(dir_path)
+                    except OSError:  # directory isn't empty
+                        pass
+                continue
+            if path.exists(dest_path) and not path.exists(src_path):
+                print(f'moving back "{dest_path}"')
+                renames(dest_path, src_path)
+                self.manifest.move(dest_path, src_path)
+            if n in originals and path.exists(src_path):
+                restore_tags(src_path, *originals[n])
+        self.manifest.commit()
+
+    def write_plan(self, report_path, moves):
+        '''
+        Writes dry run report, as JSON, to a file or to stdout ('-').
+
+        Report lists every operation the run would do, in order, with paths
+        files really have, then tag changes of each track (old and new
+        value of every changed field, with its length and bitrate), then
+        tracks which need editing.
+        '''
+        tag_fields = {'album_artist': 'album_artist', 'artist': 'artist',
+                      'album': 'album', 'title': 'title',
+                      'recording_date': 'date', 'track_num': 'track_num',
+                      'disc_num': 'disc'}
+        tag_changes = []
+        errors      = []
+
+        for move in moves:
+            if move['tags'] is None:
+                continue
+            src_path = self.tree.real_path(move['src'])
+            if move.get('error'):
+                errors.append({'path': src_path, 'error': move['error']})
+
+            old_tags = self.read_tags(src_path)
+            changes  = {}
+            for field, new_val in move['tags'].items():
+                old_val = old_tags.get(tag_fields[field])
+                old_val = '' if old_val is None else str(old_val)
+                if old_val != new_val:
+                    changes[field] = [old_val, new_val]
+            tag_changes.append({'path': src_path, 'dest': move['dest'],
+                                'changes': changes,
+                                'audio': {key: old_tags[key] for key in
+                                          ('time_secs', 'kbps', 'min_kbps',
+                                           'max_kbps', 'vbr')}})
+
+        ops    = [op['op'] for op in self.tree.log]
+        report = {'summary':    {'moves':        ops.count('move'),
+                                 'copies':       ops.count('copy'),
+                                 'deletions':    ops.count('delete'),
+                                 'compressions': ops.count('compress'),
+                                 'tracks':       len(tag_changes),
+                                 'errors':       len(errors)},
+                  'operations': self.tree.log,
+                  'tags':       tag_changes,
+                  'errors':     errors}
+
+        if report_path == '-':
+            json.dump(report, self.plan_out, indent=1, ensure_ascii=False)
+            self.plan_out.write('\n')
+        else:
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=1, ensure_ascii=False)
+
+    def load_nlp(self):
+        '''
+        Loads spacy model on first use and keeps it for all later runs.
+
+        Pipeline components that capitalization doesn't use are removed,
+        as only part-of-speech tags and dependency labels are needed.
+        '''
+        if self.nlp is None:
+            import spacy
+
+            self.nlp = spacy.load(self.s.nlp_model)
+            for pipe_name in ['ner', 'lemmatizer', 'textcat', 'entity_ruler']:
+                if pipe_name in self.nlp.pipe_names:
+                    self.nlp.remove_pipe(pipe_name)
+        return self.nlp
+
+    def nlp_capitalize(self, titles):
+        '''
+        The Chicago Manual of Style capitalization instructions for Spacy.
+
+        Titlechaser was stripped and converted into a function for purposes
+        of this program. Below is its original address:
+        https://github.com/tummychow/titlechaser
+
+        Takes a list of tag values and returns them capitalized. Each value
+        is parsed as separate document, in batches, so that neighbouring
+        values don't affect how its words are tagged.
+        '''
+        TO_CAPITALIZE = {'NN','NNS','NNP','NNPS','PRP','PRP$','WP','WP$','JJ',
+        				 'JJR','JJS','MD','VB','VBD','VBG','VBN','VBP','VBZ','RB',
+        				 'RBR','RBS','RP','WRB'}
+
+        def capitalize_token(arg, idx):
+            tok = arg[idx]
+            return (
+                (idx == 0 or idx == len(arg)-1) or
+                (tok.tag_ in TO_CAPITALIZE) or
+                (tok.tag_ == 'IN' and tok.dep_ in {'mark', 'complm'}) or
+                (idx > 0 and idx < len(arg)-1 and arg[idx+1].tag_ == 'HYPH'
+                  and arg[idx-1].tag_ != 'HYPH'))
+
+        def titlecase_tokens(arg):
+            ret = []
+            for idx, tok in enumerate(arg):
+                ret.append(tok.orth_.capitalize() if capitalize_token(arg, idx)
+                           else tok.orth_)
+                ret.append(tok.whitespace_)
+            return ret
+
+        titles  = [str(title).replace('\\', '/') for title in titles]
+        to_nlp  = [title for title in titles if title]
+        if not to_nlp:  # no need to load the model
+            return titles
+        self.metrics.count('nlp docs', len(to_nlp))
+        docs    = self.load_nlp().pipe(to_nlp,
+                                       batch_size=self.s.nlp_batch_size,
+                                       n_process=max(self.jobs, 1))
+        output  = iter([''.join(titlecase_tokens(doc)) for doc in docs])
+        return [next(output) if title else title for title in titles]
+
+    def repair_mp3(self, mp3_path):
+        '''Fixes errors in an mp3 file with mp3val, returns file path.'''
+        run(['mp3val', '-f', '-nb', mp3_path], stdout=DEVNULL, stderr=DEVNULL)
+        self.metrics.count('spawns')
+        return mp3_path
+
+    def compress_img(self, img_path):
+        '''
+        Converts png image to jpg, compresses jpg if it is uncompressed.
+
+        Works with ImageMagick and jpegoptim, or with Pillow if img_backend
+        setting says so. Returns path of the resulting image.
+        '''
+        if self.s.img_backend == 'pillow':
+            return self.compress_img_pillow(img_path)
+
+        dir_path, filename = path.split(img_path)
+
+        if '.jpg' in filename:
+            c_rate = self.spawn(['identify', '-format', '%Q', img_path],
+                                stdout=PIPE)
+            c_rate = int(c_rate)
+            if c_rate == 100:
+                self.spawn(['jpegoptim', f'-m{self.s.jpg_compr_lvl}',
+                            img_path])
+
+        if '.png' in filename:
+            self.spawn(['mogrify', '-format', 'jpg', '-quality', '100',
+                        img_path])
+            remove(img_path)
+            filename = re.sub('\.png', '.jpg', filename)
+            img_path = f'{dir_path}/{filename}'
+
+            self.spawn(['jpegoptim', f'-m{self.s.jpg_compr_lvl}', img_path])
+
+        return img_path
+
+    def compress_cached(self, img_path):
+        '''
+        Does the same as compress_img, unless image cache has the result
+        already: then it is only put in place. Results of compression
+        get stored in the cache, with CPU time it took, programs it
+        started included.
+        '''
+        cache = self.img_cache
+        if not cache:
+            return self.compress_img(img_path)
+
+        digest   = cache.digest(img_path)
+        out_path = cache.restore(digest, img_path)
+        if out_path:
+            self.metrics.count('cached_imgs')
+            return out_path
+
+        in_stat  = stat(img_path)
+        start    = thread_time() + getattr(self.spawned, 'cpu', 0.0)
+        out_path = self.compress_img(img_path)
+        cpu_secs = thread_time() + getattr(self.spawned, 'cpu', 0.0) - start
+        out_stat = stat(out_path)
+        changed  = out_path != img_path or \
+                   (out_stat.st_size, out_stat.st_mtime_ns) != \
+                   (in_stat.st_size, in_stat.st_mtime_ns)
+        cache.store(digest, in_stat.st_size, out_path, changed, cpu_secs)
+        return out_path
+
+    def spawn(self, args, stdout=DEVNULL):
+        '''
+        Runs a program with spawn, returns its output. CPU time it took
+        is added to that of all programs the current thread started.
+        '''
+        output, cpu_secs = spawn(args, stdout)
+        self.spawned.cpu = getattr(self.spawned, 'cpu', 0.0) + cpu_secs
+        self.metrics.count('spawns')
+        return output
+
+    def compress_img_pillow(self, img_path):
+        '''Does the same as compress_img, without spawning any programs.'''
+        from PIL import Image
+
+        dir_path, filename = path.split(img_path)
+
+        if '.jpg' in filename:
+            with Image.open(img_path) as img:
+                if jpg_quality(img) == 100:
+                    img.load()
+                    img.save(img_path, quality=self.s.jpg_compr_lvl,
+                             optimize=True, exif=img.info.get('exif', b''),
+                             icc_profile=img.info.get('icc_profile'))
+
+        if '.png' in filename:
+            filename = re.sub('\.png', '.jpg', filename)
+            jpg_path = f'{dir_path}/{filename}'
+
+            with Image.open(img_path) as img:
+                img.convert('RGB').save(jpg_path,
+                                        quality=self.s.jpg_compr_lvl,
+                                        optimize=True)
+            remove(img_path)
+            img_path = jpg_path
+
+        return img_path
+
+    def free_jpg_names(self, dir_path, img_paths):
+        '''
+        Renames png images of a directory whose jpg would replace an image
+        already there, returns their paths updated.
+
+        Images of a directory get compressed at once by several workers,
+        so x.png turned into x.jpg mustn't land on x.jpg being worked on.
+        Names don't matter much, images get renamed after compression.
+        '''
+        names = set(self.tree.listdir(dir_path))
+        freed = []
+        for img_path in img_paths:
+            stem, ext = path.splitext(img_path.split('/')[-1])
+            if ext == '.png' and f'{stem}.jpg' in names:
+                n = 1
+                while {f'{stem}-{n}.png', f'{stem}-{n}.jpg'} & names:
+                    n += 1
+                free_path = f'{dir_path}/{stem}-{n}.png'
+                self.tree.rename(img_path, free_path)
+                self.move_cached(img_path, free_path)
+                names.add(f'{stem}-{n}.png')
+                img_path = free_path
+            freed.append(img_path)
+        return freed
+
+    def rename_img(self, dir_path, filename, replace_with):
+        rgx_search        = "^.+(?=(?:.jpg|.png))"
+        renamed_file      = re.sub(rgx_search, replace_with, filename)
+        renamed_file_path = f'{dir_path}/{renamed_file}'
+        self.tree.rename(f'{dir_path}/{filename}', renamed_file_path)
+        self.move_cached(f'{dir_path}/{filename}', renamed_file_path)
+
+
+class Inotify:
+    '''
+    Reports changes in watched directories, with Linux inotify.
 
-        dest_name         = f'{t_no} {parsed.tag.title}.mp3'
-        dest_album_folder = (f'{parsed.tag.album_artist} - '
-        					 f'{parsed.tag.recording_date} - '
-        					 f'{parsed.tag.album}')
-        final_dir         = f'{s.dest_dir}/{dest_album_folder}'
+    libc is called through ctypes, so nothing needs to be installed.
+    Each event is a (watched directory, name of changed item, event
+    mask) tuple; after queue overflow, when events got lost, directory
+    is None.
+    '''
+    # modify, attrib, close write, moved from, moved to, create, delete
+    CHANGES  = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    ONLY_DIR = 0x1000000
+    OVERFLOW = 0x4000
+    IGNORED  = 0x8000
+    EVENT    = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        from ctypes.util import find_library
+
+        self.libc      = ctypes.CDLL(find_library('c'), use_errno=True)
+        self.get_errno = ctypes.get_errno
+        fd             = self.libc.inotify_init1(0o2000000)  # IN_CLOEXEC
+        if fd < 0:
+            err = self.get_errno()
+            raise OSError(err, strerror(err))
+        self.file    = open(fd, 'rb', buffering=0)
+        self.watches = {}  # watch descriptor: directory path
+
+    def add(self, dir_path):
+        '''Watches a directory, unless it's already gone.'''
+        wd = self.libc.inotify_add_watch(self.file.fileno(),
+                                         fsencode(dir_path),
+                                         self.CHANGES | self.ONLY_DIR)
+        if wd < 0:
+            err = self.get_errno()
+            if err in (ENOENT, ENOTDIR):
+                return
+            raise OSError(err, strerror(err), dir_path)
+        self.watches[wd] = dir_path
+
+    def add_tree(self, dir_path):
+        '''Watches a directory and all directories below it.'''
+        for curr_dir, _, _ in walk(dir_path):
+            self.add(curr_dir)
+
+    def remove_tree(self, dir_path):
+        '''Stops watching a directory and all directories below it.'''
+        for wd, watched in list(self.watches.items()):
+            if watched == dir_path or watched.startswith(f'{dir_path}/'):
+                self.libc.inotify_rm_watch(self.file.fileno(), wd)
+                del self.watches[wd]
+
+    def events(self, timeout=None):
+        '''
+        Waits up to timeout seconds (None for as long as it takes) for
+        events, returns all pending ones.
+        '''
+        events = []
+
+        while select([self.file], [], [], timeout)[0]:
+            timeout = 0
+            data    = self.file.read(1 << 16)
+            pos     = 0
+
+            while pos < len(data):
+                wd, mask, _, name_len = self.EVENT.unpack_from(data, pos)
+                pos  += self.EVENT.size
+                name  = fsdecode(data[pos:pos + name_len].rstrip(b'\0'))
+                pos  += name_len
+
+                if mask & self.IGNORED:
+                    self.watches.pop(wd, None)
+                elif mask & self.OVERFLOW:
+                    events.append((None, '', mask))
+                elif wd in self.watches:
+                    events.append((self.watches[wd], name, mask))
+        return events
+
+    def close(self):
+        self.file.close()
+
+
+class Watcher:
+    '''
+    Cleans files and albums landing in base_dir, as soon as they're
+    complete.
+
+    An item of base_dir (loose file or album directory) is complete
+    once nothing in it has changed for watch_quiet_time seconds, so
+    downloads in progress are never touched. Each album is cleaned on
+    its own, loose files complete at the same time together, all by
+    one unattended Cleaner, which keeps its caches between runs.
+    Changes the cleaner makes itself are ignored.
+    '''
+    def __init__(self, cleaner, metrics_path=None):
+        s = cleaner.s
+
+        self.cleaner      = cleaner
+        self.metrics_path = metrics_path
+        self.base_dir     = s.base_dir
+        self.quiet_time   = s.watch_quiet_time
+        self.skipped      = {s.broken_dir, s.notmp3_dir, s.duplicates_dir}
+        self.pending      = {}  # item of base_dir: time of its last change
+        self.inotify      = Inotify()
+        self.inotify.add(self.base_dir)
+        self.rescan()
+
+    def rescan(self):
+        '''Takes everything in base_dir as just changed.'''
+        with scandir(self.base_dir) as entries:
+            for entry in entries:
+                if entry.name in self.skipped:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    self.inotify.add_tree(entry.path)
+                self.pending[entry.name] = monotonic()
+
+    def update(self, events, ignored=()):
+        '''Marks items of base_dir changed by given events.'''
+        for dir_path, name, mask in events:
+            if dir_path is None:
+                self.rescan()
+                continue
+            if dir_path == self.base_dir:
+                item = name
+            else:
+                item = dir_path[len(self.base_dir) + 1:].split('/')[0]
+            if not item or item in self.skipped or item in ignored:
+                continue
+            if not path.lexists(f'{self.base_dir}/{item}'):
+                self.pending.pop(item, None)
+                continue
+
+            changed_path = f'{dir_path}/{name}'
+            if name and path.isdir(changed_path) and \
+               not path.islink(changed_path):
+                self.inotify.add_tree(changed_path)
+            self.pending[item] = monotonic()
+
+    def serve(self):
+        '''Cleans whatever gets complete, until interrupted.'''
+        print(f'Watching {self.base_dir} for new files...')
+
+        while True:
+            now   = monotonic()
+            ready = sorted(item for item, changed in self.pending.items()
+                           if now - changed >= self.quiet_time)
+            if ready:
+                for item in ready:
+                    del self.pending[item]
+                self.clean_items(ready)
+                continue
+
+            timeout = None
+            if self.pending:
+                timeout = min(self.pending.values()) + self.quiet_time - now
+            self.update(self.inotify.events(timeout))
+
+    def clean_items(self, items):
+        '''Cleans each album on its own, then all loose files at once.'''
+        item_paths = {item: f'{self.base_dir}/{item}' for item in items}
+        albums     = [[item] for item in items
+                      if path.isdir(item_paths[item])]
+        files      = [item for item in items
+                      if path.isfile(item_paths[item])]
+
+        for batch in albums + ([files] if files else []):
+            print(f'\nCleaning {", ".join(batch)}')
+            try:
+                self.cleaner.clean(batch)
+            except (SystemExit, ValueError) as err:
+                # Stuck journal needs to be dealt with by hand
+                if self.cleaner.journal.exists():
+                    raise
+                if not isinstance(err, SystemExit):
+                    print(err)
+                print(f'Left {", ".join(batch)} in {self.base_dir}')
+            if self.metrics_path:
+                self.cleaner.metrics.write(self.metrics_path)
+
+            # Whatever is left of cleaned items gets watched anew, with
+            # paths it has now, and none of the changes made by the
+            # cleaner count
+            for item in batch:
+                self.inotify.remove_tree(item_paths[item])
+            self.update(self.inotify.events(0), ignored=batch)
+            for item in batch:
+                if path.isdir(item_paths[item]):
+                    self.inotify.add_tree(item_paths[item])
+
+    def close(self):
+        self.inotify.close()
+
+
+def load_settings(settings_path=None):
+    '''Loads settings.py, or another settings file if path is given.'''
+    if not settings_path:
+        import settings
+        return settings
+
+    settings_spec = spec_from_file_location('settings', settings_path)
+    settings      = module_from_spec(settings_spec)
+    settings_spec.loader.exec_module(settings)
+    sys.modules['settings'] = settings
+    return settings
+
+
+def main():
+    '''Cleans files as told by command line arguments and settings.'''
+    parser = ArgumentParser(description='Cleans tags of mp3 files found in '
+                                        'base_dir and moves them to dest_dir.')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of files validated or images compressed '
+                             'at the same time (jobs setting by default)')
+    parser.add_argument('--full', action='store_true',
+                        help='process all files again, even those the '
+                             'manifest says were processed before')
+    parser.add_argument('--resume', action='store_true',
+                        help='finish saving and moving files of an '
+                             'interrupted run, then exit')
+    parser.add_argument('--rollback', action='store_true',
+                        help='move files of an interrupted run back where '
+                             'they were, with their old tags, then exit')
+    parser.add_argument('--plan', nargs='?', const='-', metavar='REPORT_FILE',
+                        help='only show what the program would do, as JSON '
+                             'report written to given file or to stdout, '
+                             'without touching any file')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, clean files and albums landing '
+                             'in base_dir once they are complete')
+    parser.add_argument('--settings', metavar='FILE',
+                        help='read settings from given file instead of '
+                             'settings.py')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write time, I/O and counters of each stage to '
+                             'given file: in Prometheus text format if it '
+                             'ends with .prom, as JSON otherwise')
+    parser.add_argument('--bench-rules', metavar='TAGS_FILE',
+                        help='compare tag corrections on values from given '
+                             'tag changes file with whole text regex pass, '
+                             'then exit')
+    args = parser.parse_args()
+    s    = load_settings(args.settings)
+
+    if args.bench_rules:
+        regexes = tag_regexes(s)
+        benchmark_rules(args.bench_rules, regexes, compile_rules(regexes))
+        sys.exit()
 
-        multiple_cd = re.search('\.CD\d', src_path)
-        if multiple_cd:
-            cd_num    = multiple_cd[0]
-            cd_num    = cd_num[1:]
-            final_dir = f'{s.dest_dir}/{dest_album_folder}/{cd_num}'
+    cleaner = Cleaner(s, jobs=args.jobs, full=args.full, plan=args.plan,
+                      unattended=args.watch)
 
-        renames(src_path, f'{final_dir}/{dest_name}')
+    # Dry run report goes to stdout as it was when the cleaner was made,
+    # progress messages go to stderr then
+    if args.plan == '-':
+        sys.stdout = sys.stderr
 
+    if args.resume or args.rollback:
+        if args.resume:
+            found = cleaner.resume()
+        else:
+            found = cleaner.rollback()
+        cleaner.close()
+
+        if not found:
+            print('There is no interrupted run to resume or roll back. '
+                  'Exiting...')
+        elif args.resume:
+            if args.metrics:
+                cleaner.metrics.write(args.metrics)
+            print(f'\n{cleaner.metrics.summary()}\n')
+            print(f'Tags saved: {cleaner.tags_saved[0]} in place, '
+                  f'{cleaner.tags_saved[1]} with a full file rewrite')
+        sys.exit()
 
-# Remove remaining empty folders
-dirs = [name for name in listdir(s.base_dir)
-        if path.isdir(path.join(s.base_dir, name))]
+    if args.watch:
+        watcher = Watcher(cleaner, args.metrics)
+        try:
+            watcher.serve()
+        except KeyboardInterrupt:
+            print('\nStopped watching')
+        finally:
+            watcher.close()
+            cleaner.close()
+        sys.exit()
 
-for d in dirs:
-    dir_path  = f'{s.base_dir}/{d}'
-    dir_items = listdir(dir_path)
+    cleaner.clean()
+    cleaner.close()
+    if args.metrics:
+        cleaner.metrics.write(args.metrics)
+    if args.plan:
+        sys.exit()
 
-    if not dir_items:
-        rmdir(dir_path)
+    title_cache = cleaner.title_cache
+    img_cache   = cleaner.img_cache
+    print(f'\n{cleaner.metrics.summary()}\n')
+    if title_cache:
+        print(f'Title cache: {title_cache.hits} hits, {title_cache.misses} '
+              'misses')
+    if img_cache:
+        print(f'Image cache: {img_cache.hits} hits, saved compressing '
+              f'{img_cache.saved_bytes / 1e6:.1f} MB, '
+              f'{img_cache.saved_cpu:.2f} CPU seconds')
+    print(f'Tags saved: {cleaner.tags_saved[0]} in place, '
+          f'{cleaner.tags_saved[1]} with a full file rewrite')
+
+
+if __name__ == '__main__':
+    main()
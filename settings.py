@@ -42,6 +42,30 @@ broken_dir       = '.broken'
 # of base_dir.
 notmp3_dir         = '.notmp3'
 
+# Name for directory where duplicate tracks will be moved. Subdirectory
+# of base_dir.
+duplicates_dir   = '.duplicates'
+
+# How cleaned files get to dest_dir:
+# * 'move' - files are moved, which across partitions means copying
+#   and deleting them
+# * 'reflink' - base_dir is left as it was (handy when files are still
+#   seeded from it), files are copied to dest_dir instead, with copies
+#   sharing data with originals on filesystems that support it, like
+#   btrfs or XFS; only new tags take up space there
+# * 'hardlink' - same, but images are hardlinked; tracks get new tags,
+#   so they are always reflinked or copied
+# * 'copy' - same, copies are written with new tags right away, inside
+#   the kernel, which is the fastest way across partitions
+# * hardlinks that can't be made fall back to reflinks, reflinks to
+#   copies (across partitions, on filesystems like ext4)
+# * when files are copied, the built-in validator repairs the copies
+#   and mp3val isn't run, images are compressed in dest_dir, broken,
+#   duplicate and non-mp3 files aren't copied, but stay where they are
+# * files copied once are left out of later runs, unless they change
+#   (needs manifest_file)
+output_mode      = 'move'
+
 # Write tag data to ID3v1.1 tag
 # * remember to set at least one of the two below to True
 write_to_v1 = True
@@ -67,8 +91,20 @@ tag_v2_version = (2,4,0)
 #   install it: 'sudo apt-get install mp3val'
 # * if it's not in your distro's official repo, get it from its official
 #   website: http://mp3val.sourceforge.net/
+# * with the built-in validator (see below), mp3val only gets files the
+#   validator can't repair itself
 enable_mp3val    = True
 
+# How files are checked on startup:
+# * 'builtin' - checks frame sync and headers of all frames, the last
+#   frame and tag placement, without spawning any programs; cuts off
+#   garbage after the last frame and truncated last frame, corrects
+#   frame count in Xing header; the rest is left to mp3val, if it's
+#   enabled above
+# * 'mp3val' - every file goes through mp3val (if it's enabled above),
+#   files eyed3 can't read are broken
+validator        = 'builtin'
+
 # Use Chicago Manual of Style capitalization instructions in Spacy.
 # * Spacy needs to be installed for this to work, which can be done
 #   with this command: 'pip install spacy'
@@ -81,6 +117,14 @@ enable_mp3val    = True
 #   some words
 enable_nlp       = True
 
+# Spacy language model used for capitalization, and number of tag
+# values it works on at once.
+# * the model needs to be downloaded first, for example with:
+#   'python -m spacy download en_core_web_sm'
+# * bigger batches are a bit faster, but need more memory
+nlp_model        = 'en_core_web_sm'
+nlp_batch_size   = 256
+
 
 
 # EXTRA FUNCTIONALITY:
@@ -92,6 +136,15 @@ enable_nlp       = True
 #                  ['name1', 'name2', 'name3']
 app_blacklist    = ['soulseek']
 
+# Seconds with no changes to a file or album directory in base_dir,
+# after which watch mode ('--watch') takes it as fully downloaded and
+# cleans it.
+# * watch mode doesn't check app_blacklist, as it waits for downloads
+#   to finish anyway
+# * tag changes file isn't opened in text_editor in watch mode, all
+#   corrections are done automatically
+watch_quiet_time = 30
+
 # Enable/disable adding ' EP' to album names for albums that are less
 # than x seconds long.
 ep_eval          = True
@@ -101,6 +154,34 @@ ep_eval          = True
 # to True. If ep_eval is set to False, this setting does nothing.
 ep_max_length    = 1800
 
+# Loose files in base_dir (not in any album directory) are grouped into
+# albums by their album artist, album, year and disc tags. Groups with
+# at least this many tracks are cleaned as albums, smaller ones stay
+# singles.
+# * discs of one album are joined, each disc goes into its own 'CD'
+#   subdirectory, just like album subdirectories with mp3s
+# * to treat all loose files as singles, set it to 0
+album_min_tracks = 3
+
+# What to do with duplicate tracks, i.e. mp3 files whose audio (tags
+# left out) is the same as audio of another file in base_dir, before
+# they are validated and tagged:
+# * 'move' - moves them to duplicates_dir, albums made of duplicates
+#   only are moved whole, with their images; a name already taken in
+#   duplicates_dir gets ' (2)', ' (3)'... added
+# * 'delete' - deletes them, albums made of duplicates only included
+# * 'report' - only lists them, they are cleaned like other files
+# * '' - doesn't look for duplicates
+# * of two copies in base_dir, the one in an album directory stays
+duplicates       = 'move'
+
+# Also look for duplicates of files in base_dir among mp3 files already
+# in dest_dir. dest_dir is indexed in the manifest (see below), so files
+# there are only read once and only the few with the same audio length
+# as some file in base_dir get hashed.
+# * without manifest_file, the index is kept for one run only
+duplicates_in_dest = True
+
 # Try to convert Roman numerals to Arabic numerals. Useful for
 # statistics, but alters original titles, which not everyone likes.
 roman_to_arabic  = True
@@ -119,6 +200,73 @@ img_min_size     = 15360
 img_conv_compr   = True
 jpg_compr_lvl    = 95
 
+# Tool used for converting and compressing images:
+# * 'magick' - ImageMagick and jpegoptim, needs both installed
+# * 'pillow' - Python imaging library, much faster as it doesn't start
+#   three programs for every image. Install with 'pip install pillow'
+img_backend      = 'magick'
+
+# Embed album's front cover (front.jpg) in ID3v2 tag of each of its
+# tracks, for players that don't look for cover files. It is saved
+# together with other tags, in the same write.
+# * needs Pillow installed: 'pip install pillow'
+# * covers bigger than embed_front_size pixels (in width or height)
+#   are scaled down; each album's cover is made once for all tracks
+# * tag of every track grows by the size of the cover, so most files
+#   get rewritten whole, instead of having tags saved in place
+embed_front      = False
+embed_front_size = 600
+
+
+
+# PERFORMANCE:
+
+# Number of files validated and repaired (and images compressed) at the
+# same time. Each job runs its own mp3val process, so setting it to the
+# number of CPU cores speeds up those stages considerably. Spacy uses
+# the same number of processes for capitalization.
+# * can be overridden when starting the program: '--jobs 8'
+# * 1 validates files one by one
+jobs             = 1
+
+# File which remembers corrected artist names, album names and titles
+# between runs, so that values seen before don't have to be capitalized
+# and corrected again. It is rebuilt automatically after text removal,
+# text replacement or capitalization settings are changed.
+# * leave empty quotes to disable it
+# * title_cache_size is the maximum number of remembered values, least
+#   recently used ones are forgotten first
+title_cache_file = '~/.cache/mp3cleaner/titles.db'
+title_cache_size = 100000
+
+# Directory which keeps images compressed by the program, so that the
+# same image found again (in another edition of an album, or in a
+# re-download) is copied from there instead of being converted and
+# compressed again. Images are recognized by content, not by name.
+# * leave empty quotes to disable it
+# * img_cache_size is the maximum size of kept images, in megabytes,
+#   least recently used ones are removed first
+img_cache_dir    = '~/.cache/mp3cleaner/images'
+img_cache_size   = 500
+
+# File which keeps track of files already validated, read and moved by
+# the program, and of images already compressed. Unchanged files are
+# skipped by those stages on the next run, so rerunning the program
+# after a failed or interrupted run (or on a directory where new albums
+# are added all the time) takes just a moment.
+# * leave empty quotes to process everything on every run
+# * to process everything just once, start the program with '--full'
+manifest_file    = '~/.cache/mp3cleaner/manifest.db'
+
+# File where tag saving and file moving stage writes down its plan
+# before touching any file, and marks progress as it goes. If the
+# program gets interrupted at that stage, the file stays behind and the
+# next run refuses to start until it's dealt with.
+# * start the program with '--resume' to finish interrupted run, or with
+#   '--rollback' to move files back where they were, with their old tags
+# * leave empty quotes to disable it (not recommended)
+journal_file     = '~/.cache/mp3cleaner/journal.jsonl'
+
 
 
 # TEXT REMOVALS